@@ -6,23 +6,331 @@ import logging.handlers
 import argparse
 import json
 import itertools
-
+import threading
+import time
+import os
+import hashlib
+import gc
+import resource
+import signal
+import weakref
+import multiprocessing
+import random
+import email.utils
+import Queue
+import gzip
+import sys
+
+import appdirs
 import requests
+import requests.adapters
 
-import libcloud.compute.types
-import libcloud.compute.providers
+# libcloud is imported by libcloud_driver once a zone needs a driver
 
 
 class UnknownDriverError(Exception):
     pass
 
 
+class InvalidSnapshotError(Exception):
+    pass
+
+
 class InvalidZoneConfigError(Exception):
     pass
 
 
+def imap_bounded(func, items, concurrency=1, timeout=None):
+    """Call func for every item using at most concurrency threads, yielding results in the order of items.
+
+    items is consumed lazily, so at most concurrency results are computed ahead of
+    the consumer. An item whose call raises or doesn't finish within timeout seconds
+    yields None; a timed out call keeps running in the background but no longer
+    occupies a slot.
+    """
+    items = iter(items)
+    limit = max(concurrency, 1)
+    args = {}
+    done = {}
+    running = {}
+    cond = threading.Condition()
+    started = 0
+    exhausted = False
+    index = 0
+
+    def worker(i):
+        result = None
+        try:
+            result = func(args[i])
+        except Exception as e:
+            logging.getLogger('idbiaas').error("%s failed for %s: %s", func.__name__, args[i], e)
+
+        with cond:
+            if i in running:
+                del running[i]
+                done[i] = result
+                cond.notify()
+
+    while True:
+        # start calls for free slots, items are pulled without holding the lock
+        while not exhausted and started - index < limit:
+            try:
+                item = next(items)
+            except StopIteration:
+                exhausted = True
+                break
+
+            with cond:
+                args[started] = item
+                running[started] = time.time() + timeout if timeout else None
+                t = threading.Thread(target=worker, args=(started,))
+                t.daemon = True
+                t.start()
+                started += 1
+
+        if exhausted and index == started:
+            return
+
+        with cond:
+            if not done.has_key(index):
+                deadlines = [d for d in running.values() if d is not None]
+                if deadlines:
+                    cond.wait(max(min(deadlines) - time.time(), 0))
+                else:
+                    # Condition.wait without timeout can't be interrupted by ctrl-c on python 2
+                    cond.wait(60)
+
+                now = time.time()
+                for i, deadline in list(running.items()):
+                    if deadline is not None and deadline <= now:
+                        logging.getLogger('idbiaas').error("%s timed out after %ss for %s",
+                                                           func.__name__, timeout, args[i])
+                        del running[i]
+                        done[i] = None
+
+            if not done.has_key(index):
+                continue
+
+            result = done.pop(index)
+            del args[index]
+
+        index += 1
+        yield result
+
+
+def map_bounded(func, items, concurrency=1, timeout=None):
+    """Like imap_bounded, but return all results as a list."""
+    return list(imap_bounded(func, items, concurrency, timeout))
+
+
+def buffered(iterable, size):
+    """Iterate iterable in a separate thread, keeping up to size items ahead of the consumer.
+
+    If the consumer stops early the producer stops too, closing iterable if it can.
+    An exception raised by iterable is raised to the consumer after the items before it.
+    """
+    queue = Queue.Queue(max(size, 1))
+    end = object()
+    stop = threading.Event()
+    # sys.exc_info() of the exception ending iterable
+    error = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    if hasattr(iterable, "close"):
+                        iterable.close()
+                    return
+        except Exception:
+            error.extend(sys.exc_info())
+        finally:
+            put(end)
+
+    t = threading.Thread(target=produce)
+    t.daemon = True
+    t.start()
+
+    try:
+        while True:
+            item = queue.get()
+            if item is end:
+                if error:
+                    raise error[0], error[1], error[2]
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def shard_of(name, count):
+    """Return which of count shards is responsible for name, using rendezvous hashing.
+
+    Changing the number of shards only moves the names taken over by new shards or
+    left by removed ones.
+    """
+    return max(range(count), key=lambda i: hashlib.sha1("%s/%d" % (name, i)).digest())
+
+
+def libcloud_driver(provider):
+    """Return the libcloud driver class for provider, e.g. "libvirt"."""
+    import libcloud.compute.providers
+    return libcloud.compute.providers.get_driver(provider)
+
+
+class ConnectPendingError(Exception):
+    """Raised if another thread is still connecting the driver after DriverCache.connect_wait seconds."""
+    pass
+
+
+class DriverCache(object):
+    """libcloud drivers shared between zones and daemon runs.
+
+    Drivers are keyed by (provider, uri or token, version), checked for a live
+    connection before reuse and closed after max_idle seconds without use.
+    """
+
+    max_idle = 600
+    # seconds to wait for another thread checking or connecting the same driver
+    connect_wait = 60
+
+    _lock = threading.Lock()
+    # key -> [driver, time of last use]
+    _entries = {}
+    # key -> event set once the thread checking or creating the driver for key is done
+    _pending = {}
+
+    @classmethod
+    def get(cls, provider, key, version, factory):
+        """Return a healthy cached driver, creating it with factory() if necessary.
+
+        Raises ConnectPendingError if another thread is still at it after connect_wait
+        seconds, e.g. because the host hangs, instead of piling up threads behind it.
+        """
+        cache_key = (provider, key, version)
+
+        while True:
+            with cls._lock:
+                pending = cls._pending.get(cache_key)
+                if pending is None:
+                    done = cls._pending[cache_key] = threading.Event()
+                    break
+
+            if not pending.wait(cls.connect_wait):
+                raise ConnectPendingError("still connecting the %s driver after %ss" % (provider, cls.connect_wait))
+
+        try:
+            with cls._lock:
+                entry = cls._entries.get(cache_key)
+
+            if entry is not None and not cls.healthy(entry[0]):
+                logging.getLogger('idbiaas').info("Driver for %s %s is dead, reconnecting", provider, version)
+                cls.discard(provider, key, version)
+                entry = None
+
+            if entry is None:
+                entry = [factory(), time.time()]
+                with cls._lock:
+                    cls._entries[cache_key] = entry
+
+            entry[1] = time.time()
+            return entry[0]
+        finally:
+            with cls._lock:
+                del cls._pending[cache_key]
+            done.set()
+
+    @classmethod
+    def discard(cls, provider, key, version):
+        """Close and forget a driver, e.g. after an error."""
+        with cls._lock:
+            entry = cls._entries.pop((provider, key, version), None)
+
+        if entry is not None:
+            cls.close_driver(entry[0])
+
+    @classmethod
+    def healthy(cls, driver):
+        """Return False if the driver has a connection that is known to be dead."""
+        connection = getattr(driver, "connection", None)
+        if hasattr(connection, "isAlive"):
+            try:
+                return connection.isAlive() == 1
+            except Exception:
+                return False
+
+        return True
+
+    @classmethod
+    def close_driver(cls, driver):
+        connection = getattr(driver, "connection", None)
+        # libvirt connections are closed directly, http based drivers wrap their connection
+        if not hasattr(connection, "close"):
+            connection = getattr(connection, "connection", None)
+
+        try:
+            if connection is not None and hasattr(connection, "close"):
+                connection.close()
+        except Exception as e:
+            logging.getLogger('idbiaas').debug("Closing driver failed: %s", e)
+
+    @classmethod
+    def evict_idle(cls):
+        """Close drivers not used for max_idle seconds."""
+        deadline = time.time() - cls.max_idle
+
+        with cls._lock:
+            idle = [k for k, entry in cls._entries.items() if entry[1] < deadline]
+
+        for cache_key in idle:
+            cls.discard(*cache_key)
+
+    @classmethod
+    def close(cls):
+        """Close all drivers, called on shutdown."""
+        with cls._lock:
+            keys = cls._entries.keys()
+
+        for cache_key in keys:
+            cls.discard(*cache_key)
+
+
 class Zone(object):
     create = False
+    # False if machines() couldn't list all of the zone, e.g. a host failed
+    complete = True
+    # driver name -> zone class, see register
+    drivers = {}
+    # entry point group of zone classes provided by other packages, by driver name
+    entry_point_group = "idbiaas.zones"
+
+    @classmethod
+    def register(cls, name, zone_class):
+        """Make zone_class available as driver name, zone_class.from_dict gets the driver configuration."""
+        cls.drivers[name] = zone_class
+
+    @classmethod
+    def driver_class(cls, name):
+        """Return the zone class registered for a driver name, loading it from an entry point if necessary."""
+        if not cls.drivers.has_key(name):
+            # only imported for drivers of other packages, it is slow to import
+            import pkg_resources
+            for entry_point in pkg_resources.iter_entry_points(cls.entry_point_group, name):
+                cls.register(name, entry_point.load())
+                break
+            else:
+                raise UnknownDriverError("Unknown driver: " + name)
+
+        return cls.drivers[name]
 
     @classmethod
     def verifies(cls, dict_config):
@@ -51,21 +359,28 @@ class Zone(object):
     
         try:
             # select right zone class by driver name
-            name = dict_config["driver"]["name"]
-            if name == "digitalocean":
-                zone = DigitalOceanZone.from_dict(dict_config["driver"])
-            elif name == "libvirt":
-                zone = LibvirtZone.from_dict(dict_config["driver"])
-            else:
-                raise UnknownDriverError("Unknown driver: " + name)
+            zone = Zone.driver_class(dict_config["driver"]["name"]).from_dict(dict_config["driver"])
         except KeyError as expt:
             raise InvalidZoneConfigError(
                 "Invalid zone configuration: " + expt.message)
 
         zone.idb = idb
+        # identifies the zone in the sync state across runs
+        zone.key = hashlib.sha1(json.dumps(dict_config["driver"], sort_keys=True)).hexdigest()[:12]
+        # seconds between runs in daemon mode, None for the daemon default
+        zone.interval = None
+
+        if dict_config.has_key("interval"):
+            zone.interval = dict_config["interval"]
         
         return zone
 
+    def shard(self, index, count):
+        """Return the part of this zone crawled by shard index of count, or None if there is nothing to crawl."""
+        if shard_of(self.key, count) == index:
+            return self
+        return None
+
     @property
     def idb(self):
         return self._idb
@@ -91,15 +406,174 @@ class LibvirtVMHost(object):
         """Return an uri for usage with libcloud."""
         return 'qemu+ssh://' + self.user + '@' + self.name + '/system'
 
+    def __repr__(self):
+        return self.uri()
+
+
+class LibvirtRPCCounter(object):
+    """Proxy for a libvirt connection or domain counting the remote calls made through it.
+
+    Domains returned by the connection are wrapped as well, so calls libcloud makes
+    for every node are counted too.
+    """
+
+    # calls answered from data the client already has
+    local = frozenset(["name", "ID", "UUID", "UUIDString", "isAlive"])
+
+    _lock = threading.Lock()
+    _calls = {}
+
+    @classmethod
+    def calls(cls, uri):
+        """Return the number of calls made so far to the host at uri."""
+        with cls._lock:
+            return cls._calls.get(uri, 0)
+
+    @classmethod
+    def count(cls, uri):
+        with cls._lock:
+            cls._calls[uri] = cls._calls.get(uri, 0) + 1
+
+    def __init__(self, target, uri):
+        self._target = target
+        self._uri = uri
+
+    def wrap(self, result):
+        if isinstance(result, list):
+            return [self.wrap(x) for x in result]
+        # getAllDomainStats returns (domain, stats) tuples
+        if isinstance(result, tuple):
+            return tuple(self.wrap(x) for x in result)
+        # libvirt domains are the only objects with XMLDesc
+        if hasattr(result, "XMLDesc"):
+            return LibvirtRPCCounter(result, self._uri)
+        return result
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr) or name in LibvirtRPCCounter.local:
+            return attr
+
+        def call(*args, **kwargs):
+            LibvirtRPCCounter.count(self._uri)
+            return self.wrap(attr(*args, **kwargs))
+
+        return call
+
+
+class LibvirtCollector(object):
+    """Lists the domains of a libvirt host with a single getAllDomainStats call.
+
+    libcloud's list_nodes makes several calls for every domain, the stats contain
+    everything needed for an IDBMachine. Only domains without vcpu or balloon stats
+    are asked for their info.
+    """
+
+    # VIR_DOMAIN_STATS_STATE | BALLOON | VCPU | INTERFACE | BLOCK
+    stats = 1 | 4 | 8 | 16 | 32
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def ex_get_hypervisor_hostname(self):
+        return self.connection.getHostname()
+
+    def machines(self, hostname, details=False):
+        """Return the machines of all domains, with their disks and network interfaces if details is set."""
+        machines = []
 
-class LibvirtZone(Zone):
+        for domain, stats in self.connection.getAllDomainStats(LibvirtCollector.stats):
+            cpu = stats.get("vcpu.current")
+            memory = stats.get("balloon.current")
+            if cpu is None or memory is None:
+                info = domain.info()
+                cpu, memory = info[3], info[2]
+
+            machine = IDBMachine(domain.name(), hostname, cpu, memory // 1024)
+
+            if details:
+                machine.diskspace = sum(stats.get("block.%d.capacity" % i, 0) for i in range(stats.get("block.count", 0)))
+                machine.nics = [{"name": stats["net.%d.name" % i]} for i in range(stats.get("net.count", 0))
+                                if stats.has_key("net.%d.name" % i)]
+
+            machines.append(machine)
+
+        return machines
+
+
+class PartitionedZone(Zone):
+    """Base of zones whose listing is split into parts, e.g. hosts, regions or pages.
+
+    Up to concurrency parts are listed at once and a part taking longer than timeout
+    seconds is skipped. Machines are yielded part by part in the order of parts(), as
+    soon as a part is listed. The listing of each part is observed as part_metric.
+    """
+
+    part_metric = "zone_part"
+    part_label = "part"
+
+    def __init__(self, concurrency=8, timeout=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    def parts(self):
+        """Return the parts of the listing."""
+        raise NotImplementedError
+
+    def part_machines(self, part):
+        """Return the machines of a part, or None if listing it failed."""
+        raise NotImplementedError
+
+    def part_name(self, part):
+        return str(part)
+
+    def listed_part(self, part):
+        start = Metrics.start()
+        machines = self.part_machines(part)
+        Metrics.observe(self.part_metric, ((self.part_label, self.part_name(part)),), start,
+                        machines is None, len(machines or []))
+        return machines
+
+    def machines(self):
+        """List up to concurrency parts at once, yielding machines part by part in the order of parts."""
+        self.complete = True
+        for machines in imap_bounded(self.listed_part, self.parts(), self.concurrency, self.timeout):
+            if machines is None:
+                self.complete = False
+                continue
+            for machine in machines:
+                yield machine
+
+
+class LibvirtZone(PartitionedZone):
     """Implements crawling libvirt hosts for vm nodes."""
 
+    part_metric = "libvirt_host"
+    part_label = "host"
+
     @classmethod
     def from_dict(cls, dict_config):
         hosts = LibvirtZone.hosts_from_dict(dict_config["hosts"])
+        concurrency = 8
+        timeout = None
+
+        if dict_config.has_key("concurrency"):
+            concurrency = dict_config["concurrency"]
+
+        if dict_config.has_key("timeout"):
+            timeout = dict_config["timeout"]
+
+        zone = LibvirtZone(hosts, concurrency, timeout)
 
-        return LibvirtZone(hosts)
+        if dict_config.has_key("collector"):
+            if dict_config["collector"] not in ("libcloud", "native"):
+                raise InvalidZoneConfigError("Invalid zone configuration: unknown collector " + dict_config["collector"])
+            zone.collector = dict_config["collector"]
+
+        if dict_config.has_key("details"):
+            zone.details = dict_config["details"]
+
+        return zone
 
     @classmethod
     def hosts_from_dict(cls, dict_hosts):
@@ -109,90 +583,1165 @@ class LibvirtZone(Zone):
             hosts.append(LibvirtVMHost.from_dict(host))
         return hosts
 
-    def __init__(self, hosts):
+    def __init__(self, hosts, concurrency=8, timeout=None):
+        PartitionedZone.__init__(self, concurrency, timeout)
         self.hosts = hosts
+        # "libcloud" lists domains with libcloud, "native" with a LibvirtCollector
+        self.collector = "libcloud"
+        # collect disks and network interfaces, native collector only
+        self.details = False
+
+    def shard(self, index, count):
+        """Keep the hosts of shard index of count, the hosts of a zone are spread over all shards."""
+        self.hosts = [h for h in self.hosts if shard_of(h.name, count) == index]
+        if self.hosts:
+            return self
+        return None
+
+    # facts about a host, fetched once per driver (and so per connection)
+    _facts_lock = threading.Lock()
+    _facts = weakref.WeakKeyDictionary()
 
-    def machines(self):
+    @classmethod
+    def host_facts(cls, driver):
+        """Return the hypervisor hostname of a host, memoized per connection."""
+        with cls._facts_lock:
+            facts = cls._facts.get(driver)
+
+        if facts is None:
+            facts = {"hostname": driver.ex_get_hypervisor_hostname()}
+            with cls._facts_lock:
+                cls._facts[driver] = facts
+
+        return facts
+
+    def connect(self, host):
+        """Return a new libcloud driver for host, counting its libvirt calls."""
+        driver = libcloud_driver("libvirt")(uri=host.uri())
+        driver.connection = LibvirtRPCCounter(driver.connection, host.uri())
+        return driver
+
+    def parts(self):
+        return self.hosts
+
+    def part_machines(self, host):
+        return self.host_machines(host)
+
+    def connect_native(self, host):
+        """Return a LibvirtCollector on a new read-only connection to host, counting its libvirt calls."""
+        import libvirt
+        return LibvirtCollector(LibvirtRPCCounter(libvirt.openReadOnly(host.uri()), host.uri()))
+
+    def native_machines(self, host):
+        driver = DriverCache.get("libvirt-native", host.uri(), None, lambda: self.connect_native(host))
+        return driver.machines(self.host_facts(driver)["hostname"], self.details)
+
+    def host_machines(self, host):
+        """Return the machines running on a single libvirt host, or None if the host failed."""
         idb_machines = []
 
-        for host in self.hosts:
-            logging.getLogger('idbiaas').info("LibvirtZone: retrieving nodes from %s", host.uri())
+        logging.getLogger('idbiaas').info("LibvirtZone: retrieving nodes from %s", host.uri())
+        calls = LibvirtRPCCounter.calls(host.uri())
+        failed = False
 
-            try:
-                driver = libcloud.compute.providers.get_driver(
-                    libcloud.compute.types.Provider.LIBVIRT)(uri=host.uri())
+        try:
+            if self.collector == "native":
+                idb_machines = self.native_machines(host)
+            else:
+                driver = DriverCache.get("libvirt", host.uri(), None,
+                                         lambda: self.connect(host))
 
                 nodes = driver.list_nodes()
+                hostname = self.host_facts(driver)["hostname"]
                 for node in nodes:
                     logging.getLogger('idbiaas').debug("LibvirtZone: got node %s", node)
                     idb_machines.append(IDBMachine(
-                        node.name, driver.ex_get_hypervisor_hostname(),
+                        node.name, hostname,
                         node.extra['vcpu_count'], node.extra['used_memory']))
-            except Exception as e:
-                logging.getLogger('idbiaas').error("LibvirtZone: %s, continuing with next host", e)
+        except Exception as e:
+            # reconnect on the next run
+            DriverCache.discard("libvirt-native" if self.collector == "native" else "libvirt", host.uri(), None)
+            logging.getLogger('idbiaas').error("LibvirtZone: %s, continuing with next host", e)
+            failed = True
+
+        logging.getLogger('idbiaas').info("LibvirtZone: %d nodes from %s using %d libvirt calls",
+                                          len(idb_machines), host.uri(),
+                                          LibvirtRPCCounter.calls(host.uri()) - calls)
+
+        if failed:
+            return None
 
         return idb_machines
 
 
 class DigitalOceanZone(Zone):
 
+    api_url = "https://api.digitalocean.com/v2"
+
     @classmethod
     def from_dict(cls, dict_config):
-        return DigitalOceanZone(dict_config["token"], dict_config["version"])
+        zone = DigitalOceanZone(dict_config["token"], dict_config["version"])
+
+        if dict_config.has_key("per_page"):
+            zone.per_page = dict_config["per_page"]
+
+        if dict_config.has_key("concurrency"):
+            zone.concurrency = dict_config["concurrency"]
+
+        if dict_config.has_key("tag"):
+            zone.tag = dict_config["tag"]
+
+        return zone
 
     def __init__(self, token, version):
         self.token = token
         self.version = version
+        # droplets per page, the API allows up to 200
+        self.per_page = 200
+        # number of pages fetched at the same time
+        self.concurrency = 4
+        # only list droplets with this tag
+        self.tag = None
+        # seconds to connect and to wait for a page
+        self.timeout = (10, 60)
+        # keep-alive session to the DigitalOcean API, created on first use
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(self.concurrency, 1))
+            self._session = requests.Session()
+            self._session.mount("https://", adapter)
+            self._session.mount("http://", adapter)
+        return self._session
+
+    def page(self, number):
+        """Return the droplets on a page of the droplet list and the total number of droplets."""
+        params = {"page": number, "per_page": self.per_page}
+        if self.tag:
+            params["tag_name"] = self.tag
+
+        res = self.session.get(self.api_url + "/droplets", params=params,
+                               headers={"Authorization": "Bearer " + self.token}, timeout=self.timeout)
+        res.raise_for_status()
+        data = res.json()
+
+        return data["droplets"], data.get("meta", {}).get("total", len(data["droplets"]))
+
+    def pages(self):
+        """Yield the droplets and the reported total of each page, fetching the pages after the first concurrently."""
+        droplets, total = self.page(1)
+        yield droplets, total
+
+        count = (total + self.per_page - 1) // self.per_page
+        logging.getLogger('idbiaas').info("DigitalOceanZone: fetching %d droplets on %d pages", total, count)
+
+        pages = imap_bounded(self.page, range(2, count + 1), self.concurrency, sum(self.timeout))
+        for number, page in enumerate(pages, 2):
+            if page is None:
+                raise Exception("page %d of droplets missing" % number)
+            yield page
 
     def machines(self):
+        """Yield the machines of all droplets."""
         logging.getLogger('idbiaas').info("DigitalOceanZone: retrieving nodes")
-        idb_machines = []
+        self.complete = True
+
+        if self.version != "v2":
+            for machine in self.driver_machines():
+                yield machine
+            return
+
+        received = 0
+        totals = set()
+        try:
+            for droplets, total in self.pages():
+                totals.add(total)
+                for droplet in droplets:
+                    received += 1
+                    logging.getLogger('idbiaas').debug("DigitalOceanZone: got droplet %s", droplet["name"])
+                    yield IDBMachine(droplet["name"], "", droplet["vcpus"], droplet["memory"])
+
+            # droplets created or destroyed while paging shift others across pages, which may be skipped
+            if totals != set([received]):
+                self.complete = False
+                logging.getLogger('idbiaas').warn("DigitalOceanZone: received %d droplets, but the API reported %s",
+                                                  received, ", ".join(str(t) for t in sorted(totals)))
+        except Exception as e:
+            self.complete = False
+            logging.getLogger('idbiaas').error("DigitalOceanZone: %s, continuing with next host", e)
 
+    def driver_machines(self):
+        """Yield the machines of all droplets using libcloud, for API versions other than v2."""
         try:
-            driver = libcloud.compute.providers.get_driver(
-                libcloud.compute.types.Provider.DIGITAL_OCEAN)(self.token, api_version=self.version)
+            driver = DriverCache.get("digitalocean", self.token, self.version,
+                                     lambda: libcloud_driver("digitalocean")(self.token, api_version=self.version))
 
             nodes = driver.list_nodes()
             for node in nodes:
                 logging.getLogger('idbiaas').debug("DigitalOceanZone: got node %s", node)
-                idb_machines.append(IDBMachine(node.name, "", node.extra["vcpus"], node.extra["memory"]))
+                yield IDBMachine(node.name, "", node.extra["vcpus"], node.extra["memory"])
         except Exception as e:
+            self.complete = False
+            DriverCache.discard("digitalocean", self.token, self.version)
             logging.getLogger('idbiaas').error("DigitalOceanZone: %s, continuing with next host", e)
 
-        return idb_machines
 
+class LibcloudZone(PartitionedZone):
+    """Nodes of any libcloud compute provider, configured by the arguments of its driver.
+
+    Every entry of regions is merged into the driver options and listed as a part of
+    its own, e.g. the regions of a cloud.
+    """
+
+    @classmethod
+    def from_dict(cls, dict_config):
+        args = []
+        options = {}
+        regions = None
+        concurrency = 4
+        timeout = None
+
+        if dict_config.has_key("args"):
+            args = dict_config["args"]
+
+        if dict_config.has_key("options"):
+            options = dict_config["options"]
+
+        if dict_config.has_key("regions"):
+            regions = dict_config["regions"]
+
+        if dict_config.has_key("concurrency"):
+            concurrency = dict_config["concurrency"]
+
+        if dict_config.has_key("timeout"):
+            timeout = dict_config["timeout"]
+
+        zone = LibcloudZone(dict_config["provider"], args, options, regions, concurrency, timeout)
+
+        if dict_config.has_key("cpu"):
+            zone.cpu_key = dict_config["cpu"]
+
+        if dict_config.has_key("ram"):
+            zone.ram_key = dict_config["ram"]
+
+        return zone
+
+    def __init__(self, provider, args, options, regions=None, concurrency=4, timeout=None):
+        PartitionedZone.__init__(self, concurrency, timeout)
+        self.provider = provider
+        self.args = args
+        self.options = options
+        self.regions = regions or [{}]
+        # keys of node.extra holding the number of cpus and the memory in MB
+        self.cpu_key = "vcpus"
+        self.ram_key = "memory"
+
+    def parts(self):
+        return self.regions
+
+    def part_name(self, region):
+        return json.dumps(region, sort_keys=True)
+
+    def driver_key(self, region):
+        # credentials are part of the arguments, the cache only gets their hash
+        return hashlib.sha1(json.dumps([self.args, self.options, region], sort_keys=True)).hexdigest()
+
+    def part_machines(self, region):
+        logging.getLogger('idbiaas').info("LibcloudZone: retrieving %s nodes in %s", self.provider,
+                                          self.part_name(region))
+        try:
+            driver = DriverCache.get(self.provider, self.driver_key(region), None,
+                                     lambda: libcloud_driver(self.provider)(*self.args, **dict(self.options, **region)))
+            nodes = driver.list_nodes()
+        except Exception as e:
+            DriverCache.discard(self.provider, self.driver_key(region), None)
+            logging.getLogger('idbiaas').error("LibcloudZone: %s, continuing with next region", e)
+            return None
+
+        return [self.node_machine(node) for node in nodes]
+
+    def node_machine(self, node):
+        """Return the machine of a node, taking cpus and memory the node extra data lacks from its size.
+
+        Values that are still unknown are None, which leaves them out of the IDB payload."""
+        cpu = node.extra.get(self.cpu_key)
+        ram = node.extra.get(self.ram_key)
+
+        size = getattr(node, "size", None)
+        if size is not None:
+            if cpu is None:
+                cpu = getattr(size, "vcpus", None) or (size.extra or {}).get("vcpus") or (size.extra or {}).get("cpu")
+            if ram is None:
+                ram = size.ram
+
+        return IDBMachine(node.name, "", cpu, ram)
+
+
+Zone.register("digitalocean", DigitalOceanZone)
+Zone.register("libvirt", LibvirtZone)
+Zone.register("libcloud", LibcloudZone)
+
+
+encode_string = json.encoder.encode_basestring_ascii
+
+
+def json_value(value):
+    """Return the JSON representation of a single machine attribute."""
+    if type(value) is int:
+        return str(value)
+    if isinstance(value, basestring):
+        return encode_string(value)
+    return json.dumps(value)
+
+
+class IDBMachine(object):
+    """IDB Machine object"""
+
+    __slots__ = ("fqdn", "vmhost", "device_type_id", "cpu", "ram", "diskspace", "nics")
+
+    # templates for json() and json(v3=True), filling them is faster than json.dumps of a dict
+    json_template = '{"fqdn": %s, "vmhost": %s, "device_type_id": %s, "cores": %s, "ram": %s}'
+    json_template_v3 = '{"fqdn": %s, "vmhost": %s, "cores": %s, "ram": %s}'
+
+    @classmethod
+    def from_dict(cls, dict_machine):
+        """Create a machine from the output of dict()."""
+        machine = IDBMachine(dict_machine["fqdn"], dict_machine["vmhost"], dict_machine.get("cores"),
+                             dict_machine.get("ram"))
+
+        if dict_machine.has_key("device_type_id"):
+            machine.device_type_id = dict_machine["device_type_id"]
+
+        machine.diskspace = dict_machine.get("diskspace")
+        machine.nics = dict_machine.get("nics")
+
+        return machine
+
+    def __init__(self, fqdn, vmhost, cpu, ram):
+        self.fqdn = fqdn
+        self.vmhost = vmhost
+        self.device_type_id = 2
+        self.cpu = cpu
+        self.ram = ram
+        # disk capacity in bytes and network interfaces, only sent if a zone collected them
+        self.diskspace = None
+        self.nics = None
+
+    def extra(self):
+        """Returns the optional informations which were collected."""
+        extra = {}
+        if self.diskspace is not None:
+            extra["diskspace"] = self.diskspace
+        if self.nics is not None:
+            extra["nics"] = self.nics
+        return extra
+
+    def known(self):
+        """Returns cores and ram if they are known, and the optional informations."""
+        known = self.extra()
+        if self.cpu is not None:
+            known["cores"] = self.cpu
+        if self.ram is not None:
+            known["ram"] = self.ram
+        return known
+
+    def dict(self):
+        """Returns the machine informations as a dictionary."""
+        return dict({"fqdn": self.fqdn, "vmhost": self.vmhost,
+                     "device_type_id": self.device_type_id}, **self.known())
+
+    def dict_v3(self):
+        """Returns the machine informations as a API v3 dictionary."""
+        return dict({"fqdn": self.fqdn, "vmhost": self.vmhost}, **self.known())
+
+    def json(self, v3=False):
+        """Returns dict() (or dict_v3()) as JSON, without building the dict."""
+        fqdn, vmhost, device_type_id, cpu, ram = self.fqdn, self.vmhost, self.device_type_id, self.cpu, self.ram
+
+        # unknown cores or ram are left out instead of overwriting the IDB with null
+        if cpu is None or ram is None:
+            return json.dumps(self.dict_v3() if v3 else self.dict(), sort_keys=True)
+
+        # strings and integers are formatted directly, everything else goes through json_value
+        if (type(fqdn) is str and type(vmhost) is str and type(device_type_id) is int
+                and type(cpu) is int and type(ram) is int):
+            fqdn = encode_string(fqdn)
+            vmhost = encode_string(vmhost)
+        else:
+            fqdn, vmhost, device_type_id, cpu, ram = [json_value(x) for x in (fqdn, vmhost, device_type_id, cpu, ram)]
+
+        if v3:
+            data = IDBMachine.json_template_v3 % (fqdn, vmhost, cpu, ram)
+        else:
+            data = IDBMachine.json_template % (fqdn, vmhost, device_type_id, cpu, ram)
+
+        if self.diskspace is None and self.nics is None:
+            return data
+
+        return data[:-1] + "".join(', %s: %s' % (encode_string(k), json_value(v))
+                                   for k, v in sorted(self.extra().items())) + "}"
+
+
+class IDBSessions(object):
+    """Keep-alive HTTP sessions shared by all zones talking to the same IDB url."""
+
+    _lock = threading.Lock()
+    # (url, verify) -> (session, pool size)
+    _sessions = {}
+    # sessions replaced by a larger pool, other threads may still use them until close
+    _retired = []
+
+    @classmethod
+    def get(cls, url, verify=True, pool_size=10):
+        """Return the session for url with a connection pool of at least pool_size.
+
+        If a larger pool is asked for, a new session replaces the existing one, so the
+        first user of a url doesn't decide the pool size of all the others. Sessions
+        are never changed while they may be in use.
+        """
+        key = (url, verify)
+
+        with cls._lock:
+            if cls._sessions.has_key(key) and cls._sessions[key][1] >= pool_size:
+                return cls._sessions[key][0]
+
+            if cls._sessions.has_key(key):
+                logging.getLogger('idbiaas').debug("Growing the connection pool for %s to %d", url, pool_size)
+                cls._retired.append(cls._sessions[key][0])
+
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.verify = verify
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            cls._sessions[key] = (session, pool_size)
+
+            return session
+
+    @classmethod
+    def stats(cls, session):
+        """Return the number of connections opened and requests sent by session."""
+        connections = 0
+        sent = 0
+        for adapter in set(session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                connections += pools[key].num_connections
+                sent += pools[key].num_requests
+        return connections, sent
+
+    @classmethod
+    def close(cls):
+        """Close all sessions, logging how many connections served how many requests."""
+        with cls._lock:
+            for (url, verify), (session, pool_size) in cls._sessions.items():
+                logging.getLogger('idbiaas').debug("Session for %s: %d connections for %d requests",
+                                                   url, *cls.stats(session))
+                session.close()
+            for session in cls._retired:
+                session.close()
+
+            cls._sessions = {}
+            cls._retired = []
+
+
+class RateLimiter(object):
+    """Token bucket allowing rate requests per second with bursts of up to burst requests."""
+
+    _lock = threading.Lock()
+    _limiters = {}
+
+    @classmethod
+    def get(cls, key, rate, burst=None):
+        """Return the limiter shared by everything using key, e.g. an IDB url."""
+        with cls._lock:
+            if not cls._limiters.has_key(key):
+                cls._limiters[key] = RateLimiter(rate, burst)
+
+            return cls._limiters[key]
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(int(rate), 1)
+        self.tokens = float(self.burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.tokens + (now - self.last) * self.rate, self.burst)
+                self.last = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class InflightLimiter(object):
+    """Cap the requests in flight to an endpoint, shared by all clients of the endpoint."""
+
+    _lock = threading.Lock()
+    _limiters = {}
+
+    @classmethod
+    def set(cls, key, limit):
+        """Limit the requests in flight for key, e.g. an IDB url, to limit, None for no limit."""
+        with cls._lock:
+            current = cls._limiters.get(key)
+            if limit is None:
+                cls._limiters.pop(key, None)
+            elif current is None or current.limit != limit:
+                # requests holding a slot of the replaced limiter release it there
+                cls._limiters[key] = InflightLimiter(limit)
+
+    @classmethod
+    def get(cls, key):
+        """Return the limiter for key, None if its requests aren't limited."""
+        with cls._lock:
+            return cls._limiters.get(key)
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.slots = threading.BoundedSemaphore(max(limit, 1))
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised instead of sending a request to an endpoint whose circuit breaker is open."""
+    pass
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to an endpoint after threshold consecutive failures.
+
+    After reset_timeout seconds a single trial request is let through, the breaker
+    closes again if it succeeds and stays open for another reset_timeout otherwise.
+    """
+
+    _lock = threading.Lock()
+    _breakers = {}
+
+    @classmethod
+    def get(cls, key, threshold=5, reset_timeout=30):
+        """Return the breaker shared by everything using key, e.g. an IDB url."""
+        with cls._lock:
+            if not cls._breakers.has_key(key):
+                cls._breakers[key] = CircuitBreaker(threshold, reset_timeout)
+
+            return cls._breakers[key]
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def open(self):
+        """True while requests are refused, without taking the trial request."""
+        with self.lock:
+            return self.opened is not None and (self.trial or time.time() - self.opened < self.reset_timeout)
+
+    def allow(self):
+        """Return True if a request may be sent now."""
+        with self.lock:
+            if self.opened is None:
+                return True
+
+            if self.trial or time.time() - self.opened < self.reset_timeout:
+                return False
+
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                if self.opened is None or self.trial:
+                    logging.getLogger('idbiaas').error("Too many failed requests, pausing requests for %ss",
+                                                       self.reset_timeout)
+                self.opened = time.time()
+                self.trial = False
+
+
+class RetryPolicy(object):
+    """Timeouts, retries and circuit breaking of the requests to an IDB url.
+
+    Failed requests are retried up to retries times with exponential backoff and
+    full jitter, waiting for Retry-After instead if the response sets it. Requests
+    which may not be repeated safely (POST) are only retried if they didn't reach
+    the IDB or were refused with 429 or 503. GETs sent with hedge are sent a second
+    time if there is no response after hedge_after seconds, the first response wins.
+    """
+
+    # responses worth another try, all of them except 429 count as failures of the endpoint
+    retry_statuses = frozenset([429, 500, 502, 503, 504])
+
+    @classmethod
+    def from_dict(cls, url, dict_config):
+        policy = RetryPolicy(url)
+
+        if dict_config.has_key("timeout"):
+            timeout = dict_config["timeout"]
+            policy.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+
+        for key in ("retries", "backoff", "max_backoff", "breaker_threshold", "breaker_reset", "hedge_after"):
+            if dict_config.has_key(key):
+                setattr(policy, key, dict_config[key])
+
+        return policy
+
+    def __init__(self, url):
+        self.url = url
+        # seconds to connect and to wait for a response
+        self.timeout = (10, 60)
+        self.retries = 3
+        self.backoff = 0.5
+        self.max_backoff = 30
+        self.breaker_threshold = 5
+        self.breaker_reset = 30
+        # seconds until a GET is sent a second time, None to never hedge
+        self.hedge_after = None
+
+    @property
+    def breaker(self):
+        return CircuitBreaker.get(self.url, self.breaker_threshold, self.breaker_reset)
+
+    def delay(self, attempt, res):
+        """Return the seconds to wait before retry number attempt, or None if Retry-After is too far away."""
+        backoff = random.uniform(0, min(self.backoff * 2 ** attempt, self.max_backoff))
+
+        retry_after = res.headers.get("Retry-After") if res is not None else None
+        if not retry_after:
+            return backoff
+
+        try:
+            wait = float(retry_after)
+        except ValueError:
+            date = email.utils.parsedate_tz(retry_after)
+            if date is None:
+                return backoff
+            wait = email.utils.mktime_tz(date) - time.time()
+
+        if wait > self.max_backoff:
+            return None
+
+        return max(wait, 0)
+
+    def hedged(self, session, prepared):
+        """Send prepared, sending it again if the first response takes longer than hedge_after."""
+        results = Queue.Queue()
+
+        def attempt():
+            try:
+                results.put((session.send(prepared.copy(), timeout=self.timeout), None))
+            except requests.exceptions.RequestException as e:
+                results.put((None, e))
+
+        def start():
+            t = threading.Thread(target=attempt)
+            t.daemon = True
+            t.start()
+
+        start()
+        try:
+            res, error = results.get(timeout=self.hedge_after)
+            return res, error
+        except Queue.Empty:
+            logging.getLogger('idbiaas').debug("No response after %ss, hedging %s %s",
+                                               self.hedge_after, prepared.method, prepared.url)
+            start()
+
+        res, error = results.get()
+        if error is not None or res.status_code in RetryPolicy.retry_statuses:
+            # the other request may still succeed
+            res, error = results.get()
+
+        return res, error
+
+    def send(self, session, prepared, idempotent=True, hedge=False, throttle=None):
+        """Send prepared, retrying failures. Raises CircuitOpenError if the IDB is considered down.
+
+        Returns the last response, even if it failed, or raises the last exception."""
+        breaker = self.breaker
+
+        for attempt in range(self.retries + 1):
+            if not breaker.allow():
+                raise CircuitOpenError("circuit breaker for %s is open" % self.url)
+
+            if throttle:
+                throttle()
+
+            # a slot is only held while the request is in flight, not while backing off
+            limiter = InflightLimiter.get(self.url)
+            if limiter:
+                limiter.slots.acquire()
+            res = error = None
+            try:
+                if hedge and self.hedge_after:
+                    res, error = self.hedged(session, prepared)
+                else:
+                    res = session.send(prepared, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                error = e
+            finally:
+                if limiter:
+                    limiter.slots.release()
+
+            if res is not None and res.status_code not in RetryPolicy.retry_statuses:
+                breaker.success()
+                return res
+
+            if res is not None and res.status_code == 429:
+                # the IDB is alive, just busy
+                breaker.success()
+            else:
+                breaker.failure()
+
+            # a request which may not be repeated is only retried if the IDB didn't process it
+            retryable = (idempotent or isinstance(error, requests.exceptions.ConnectTimeout)
+                         or res is not None and res.status_code in (429, 503))
+            if attempt == self.retries or not retryable:
+                break
+
+            wait = self.delay(attempt, res)
+            if wait is None:
+                break
+
+            logging.getLogger('idbiaas').info("%s %s failed (%s), retrying in %.1fs", prepared.method, prepared.url,
+                                              error or res.status_code, wait)
+            time.sleep(wait)
+
+        if error is not None:
+            raise error
+
+        return res
+
+
+class Metrics(object):
+    """Latency histograms, counts, errors and sizes of the stages of a sync run.
+
+    Observations are dropped while enabled is False, so instrumented code only pays
+    for the check in Metrics.start. The report is written to json_path and to
+    textfile_path in the Prometheus text format, e.g. for the node exporter
+    textfile collector. Values accumulate over the lifetime of the process.
+    """
+
+    enabled = False
+    json_path = None
+    textfile_path = None
+
+    # upper bounds of the latency histogram buckets in seconds
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    # what the size of an observation counts
+    units = {"zone_crawl": "machines", "zone_run": "machines", "libvirt_host": "machines", "idb_request": "bytes"}
+
+    _lock = threading.Lock()
+    _series = {}
+    _started = time.time()
+
+    @classmethod
+    def start(cls):
+        """Return the start time of an observation, or None if metrics and tracing are disabled."""
+        if cls.enabled or Trace.enabled:
+            return time.time()
+        return None
+
+    @classmethod
+    def observe(cls, name, labels, start, error=False, size=0):
+        """Record an observation of name started at start, labels is a tuple of (label, value) pairs."""
+        if start is None:
+            return
+
+        end = time.time()
+        elapsed = end - start
+
+        if Trace.enabled:
+            Trace.span(name, labels, start, end, error, size)
+
+        if not cls.enabled:
+            return
+
+        with cls._lock:
+            series = cls._series.get((name, labels))
+            if series is None:
+                series = cls._series[(name, labels)] = {"count": 0, "errors": 0, "seconds": 0.0, "size": 0,
+                                                        "buckets": [0] * len(cls.buckets)}
+
+            series["count"] += 1
+            series["errors"] += 1 if error else 0
+            series["seconds"] += elapsed
+            series["size"] += size
+            for i, bound in enumerate(cls.buckets):
+                if elapsed <= bound:
+                    series["buckets"][i] += 1
+                    break
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._series = {}
+            cls._started = time.time()
+
+    @classmethod
+    def snapshot(cls):
+        """Return a copy of all series, e.g. to merge them in another process."""
+        with cls._lock:
+            return [(key, dict(series, buckets=list(series["buckets"]))) for key, series in cls._series.items()]
+
+    @classmethod
+    def merge(cls, snapshot):
+        """Add the series of a snapshot to the series of this process."""
+        with cls._lock:
+            for key, other in snapshot:
+                series = cls._series.get(key)
+                if series is None:
+                    cls._series[key] = dict(other, buckets=list(other["buckets"]))
+                    continue
+
+                for field in ("count", "errors", "seconds", "size"):
+                    series[field] += other[field]
+                series["buckets"] = [a + b for a, b in zip(series["buckets"], other["buckets"])]
+
+    @classmethod
+    def report(cls):
+        """Return all series as a json compatible dict."""
+        with cls._lock:
+            series = sorted(cls._series.items())
+            report = {"started": cls._started, "seconds": time.time() - cls._started, "metrics": []}
+
+        for (name, labels), s in series:
+            report["metrics"].append({
+                "name": name,
+                "labels": dict(labels),
+                "count": s["count"],
+                "errors": s["errors"],
+                "error_rate": float(s["errors"]) / s["count"],
+                "seconds": s["seconds"],
+                cls.units.get(name, "size"): s["size"],
+                "buckets": dict((str(b), n) for b, n in zip(cls.buckets, s["buckets"])),
+            })
+
+        return report
+
+    @classmethod
+    def textfile(cls):
+        """Return all series in the Prometheus text exposition format."""
+        with cls._lock:
+            series = sorted(cls._series.items())
+
+        lines = []
+        typed = set()
+        for (name, labels), s in series:
+            prefix = "idbiaas_" + name
+            unit = cls.units.get(name, "size")
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s_seconds histogram" % prefix)
+                lines.append("# TYPE %s_errors_total counter" % prefix)
+                lines.append("# TYPE %s_%s_total counter" % (prefix, unit))
+
+            label = ",".join('%s=%s' % (k, encode_string(str(v))) for k, v in labels)
+            bucket_label = label + "," if label else ""
+            cumulative = 0
+            for bound, n in zip(cls.buckets, s["buckets"]):
+                cumulative += n
+                lines.append('%s_seconds_bucket{%sle="%s"} %d' % (prefix, bucket_label, bound, cumulative))
+            lines.append('%s_seconds_bucket{%sle="+Inf"} %d' % (prefix, bucket_label, s["count"]))
+            lines.append('%s_seconds_sum{%s} %f' % (prefix, label, s["seconds"]))
+            lines.append('%s_seconds_count{%s} %d' % (prefix, label, s["count"]))
+            lines.append('%s_errors_total{%s} %d' % (prefix, label, s["errors"]))
+            lines.append('%s_%s_total{%s} %d' % (prefix, unit, label, s["size"]))
+
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def save(cls, path, content):
+        try:
+            with open(path + ".tmp", "w") as f:
+                f.write(content)
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError) as e:
+            logging.getLogger('idbiaas').error("Can't write metrics to %s: %s", path, e)
+
+    @classmethod
+    def write(cls):
+        """Write the report to json_path and textfile_path, if set."""
+        if cls.json_path:
+            cls.save(cls.json_path, json.dumps(cls.report(), indent=2, sort_keys=True))
+
+        if cls.textfile_path:
+            cls.save(cls.textfile_path, cls.textfile())
+
+
+class Trace(object):
+    """Spans of zone crawls, host or part listings and IDB requests, written as a Chrome trace.
+
+    Every observation of Metrics is recorded as a span on the thread it ran on while
+    enabled is True. The trace is written to path as json, which can be loaded into
+    chrome://tracing or Perfetto, or compared between runs. At most max_spans spans
+    are kept.
+    """
+
+    enabled = False
+    path = None
+    max_spans = 1000000
+
+    _lock = threading.Lock()
+    _events = []
+    _threads = set()
+    _dropped = 0
+
+    @classmethod
+    def span(cls, name, labels, start, end, error=False, size=0):
+        """Record a span of name from start to end, labels is a tuple of (label, value) pairs."""
+        thread = threading.current_thread()
+        event = {"name": " ".join([name] + [str(v) for k, v in labels]), "cat": name, "ph": "X",
+                 "ts": int(start * 1000000), "dur": int((end - start) * 1000000),
+                 "pid": os.getpid(), "tid": thread.ident, "args": dict(labels, error=error, size=size)}
+
+        with cls._lock:
+            if len(cls._events) >= cls.max_spans:
+                cls._dropped += 1
+                return
+
+            if (event["pid"], thread.ident) not in cls._threads:
+                cls._threads.add((event["pid"], thread.ident))
+                cls._events.append({"name": "thread_name", "ph": "M", "pid": event["pid"], "tid": thread.ident,
+                                    "args": {"name": thread.name}})
+            cls._events.append(event)
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._events = []
+            cls._threads = set()
+            cls._dropped = 0
+
+    @classmethod
+    def snapshot(cls):
+        """Return the recorded events, e.g. to merge them in another process."""
+        with cls._lock:
+            return list(cls._events)
+
+    @classmethod
+    def merge(cls, events):
+        """Add the events of a snapshot to the events of this process."""
+        with cls._lock:
+            cls._events.extend(events)
+
+    @classmethod
+    def write(cls):
+        """Write the trace to path, if set."""
+        if not cls.path:
+            return
+
+        with cls._lock:
+            trace = {"traceEvents": list(cls._events), "displayTimeUnit": "ms",
+                     "otherData": {"dropped_spans": cls._dropped}}
+
+        Metrics.save(cls.path, json.dumps(trace))
+
+
+class Profile(object):
+    """cProfile statistics of all threads, written in the pstats format.
+
+    start profiles the calling thread and every thread started afterwards, stop
+    merges the profiles of all threads and writes them to a file, e.g. for
+    pstats.Stats(path).sort_stats("cumulative").print_stats().
+    """
+
+    _lock = threading.Lock()
+    _profiles = []
+
+    @classmethod
+    def start(cls):
+        threading.setprofile(cls.profile_thread)
+        cls.profile_thread()
+
+    @classmethod
+    def profile_thread(cls, *args):
+        """Profile the current thread, called by threading as profile function of new threads."""
+        import cProfile
+        profile = cProfile.Profile()
+        with cls._lock:
+            cls._profiles.append(profile)
+        profile.enable()
+
+    @classmethod
+    def stop(cls, path):
+        """Stop profiling and write the merged profiles to path."""
+        import pstats
+        threading.setprofile(None)
+
+        with cls._lock:
+            profiles, cls._profiles = cls._profiles, []
+
+        # Stats disables the profiles, the first one is the profile of this thread
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+
+        try:
+            stats.dump_stats(path)
+        except (IOError, OSError) as e:
+            logging.getLogger('idbiaas').error("Can't write profile to %s: %s", path, e)
+
+
+class SyncState(object):
+    """Hashes of the machines already submitted to an IDB url, kept in a local json file.
+
+    Machines whose data didn't change since they were last submitted are skipped
+    until the entry is older than ttl seconds. Sync state is disabled while
+    directory is None.
+    """
+
+    directory = None
+    ttl = 86400
+    full_resync = False
+    # (index, count) of the shard of this process, shards keep separate states
+    shard = None
+
+    _lock = threading.Lock()
+    _states = {}
+
+    @classmethod
+    def for_url(cls, url):
+        """Return the state for an IDB url, or None if sync state is disabled."""
+        if cls.directory is None:
+            return None
+
+        with cls._lock:
+            if not cls._states.has_key(url):
+                name = hashlib.sha1(url).hexdigest()
+                if cls.shard:
+                    name += ".%d-of-%d" % cls.shard
+                name += ".json"
+                cls._states[url] = SyncState(url, os.path.join(cls.directory, name))
+
+            return cls._states[url]
+
+    @classmethod
+    def save_all(cls):
+        """Write all states to disk."""
+        with cls._lock:
+            for state in cls._states.values():
+                state.save()
+
+    @classmethod
+    def machine_hash(cls, machine):
+        return hashlib.sha1(machine.json()).hexdigest()
+
+    def __init__(self, url, path):
+        self.url = url
+        self.path = path
+        self.lock = threading.Lock()
+        # fqdn -> [hash, time of submission, zone key]
+        self.entries = {}
+        # machines seen in this run, not yet submitted
+        self.pending = {}
+        # zone key -> fqdns seen in this run
+        self.seen = {}
 
-class IDBMachine(object):
-    """IDB Machine object"""
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)["machines"]
+        except (IOError, ValueError, KeyError) as e:
+            logging.getLogger('idbiaas').info("No sync state for %s in %s: %s", url, path, e)
 
-    def __init__(self, fqdn, vmhost, cpu, ram):
-        self.fqdn = fqdn
-        self.vmhost = vmhost
-        self.device_type_id = 2
-        self.cpu = cpu
-        self.ram = ram
+    def filter(self, zone, machines):
+        """Yield the machines of a zone that are new, changed or due for a refresh."""
+        now = time.time()
 
-    def dict(self):
-        """Returns the machine informations as a dictionary."""
-        return {"fqdn": self.fqdn, "vmhost": self.vmhost,
-                "device_type_id": self.device_type_id,
-                "cores": self.cpu, "ram": self.ram}
+        for machine in machines:
+            if not machine:
+                continue
 
-    def dict_v3(self):
-        """Returns the machine informations as a API v3 dictionary."""
-        return {"fqdn": self.fqdn, "vmhost": self.vmhost,
-                "cores": self.cpu, "ram": self.ram}
+            entry = [SyncState.machine_hash(machine), now, zone]
+
+            with self.lock:
+                self.seen.setdefault(zone, set()).add(machine.fqdn)
+                self.pending[machine.fqdn] = entry
+                old = self.entries.get(machine.fqdn)
 
+            if (SyncState.full_resync or old is None or old[0] != entry[0]
+                    or old[2] != zone or now - old[1] > SyncState.ttl):
+                yield machine
+            else:
+                logging.getLogger('idbiaas').debug("Machine %s unchanged, skipping", machine.fqdn)
+
+    def mark(self, machine):
+        """Record a machine as successfully submitted."""
+        with self.lock:
+            entry = self.pending.pop(machine.fqdn, None)
+            if entry:
+                self.entries[machine.fqdn] = entry
+
+    def disappeared(self, zone):
+        """Forget and return the machines of a zone that were not seen in this run."""
+        with self.lock:
+            seen = self.seen.pop(zone, set())
+            fqdns = [f for f, entry in self.entries.items() if entry[2] == zone and f not in seen]
+            for fqdn in fqdns:
+                del self.entries[fqdn]
+
+            # machines which were not submitted successfully are checked again in the next run
+            for fqdn in seen:
+                self.pending.pop(fqdn, None)
+
+        return fqdns
+
+    def forget_seen(self, zone):
+        """Forget the machines seen in an incomplete run of a zone, keeping the entries of the zone."""
+        with self.lock:
+            for fqdn in self.seen.pop(zone, set()):
+                self.pending.pop(fqdn, None)
+
+    def save(self):
+        with self.lock:
+            data = json.dumps({"url": self.url, "machines": self.entries})
+
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            with open(self.path + ".tmp", "w") as f:
+                f.write(data)
+            os.rename(self.path + ".tmp", self.path)
+        except (IOError, OSError) as e:
+            logging.getLogger('idbiaas').error("Can't save sync state to %s: %s", self.path, e)
 
 
 class IDBv2(object):
     """IDB API v2"""
 
+    # responses to a bulk PUT after which its chunk is split to find the rejected machines
+    split_statuses = (400, 413, 422)
+
     @classmethod
     def from_dict(cls,dict_config):
         create = False
         verify = True
         chunksize = 10
+        pool_size = 10
+        adaptive = False
         if dict_config.has_key("create"):
             create = dict_config["create"]
         
@@ -202,59 +1751,189 @@ class IDBv2(object):
         if dict_config.has_key("chunksize"):
             chunksize = dict_config["chunksize"]
 
-        return IDBv2(dict_config["url"], dict_config["token"],create,verify,chunksize)
+        if dict_config.has_key("pool_size"):
+            pool_size = dict_config["pool_size"]
+
+        if dict_config.has_key("adaptive"):
+            adaptive = dict_config["adaptive"]
+
+        idb = IDBv2(dict_config["url"], dict_config["token"],create,verify,chunksize,pool_size,adaptive)
+
+        if dict_config.has_key("max_chunksize"):
+            idb.max_chunksize = dict_config["max_chunksize"]
+
+        if dict_config.has_key("max_payload"):
+            idb.max_payload = dict_config["max_payload"]
+
+        if dict_config.has_key("target_latency"):
+            idb.target_latency = dict_config["target_latency"]
+
+        if dict_config.get("reconcile"):
+            raise InvalidZoneConfigError("Invalid zone configuration: reconcile requires API v3")
+
+        idb.retry = RetryPolicy.from_dict(idb.url, dict_config)
+
+        return idb
 
-    def __init__(self, url, token, create=False, verify=True, chunksize=10):
+    # API v2 can't list machines, so it can't reconcile
+    reconcile = None
+
+    def __init__(self, url, token, create=False, verify=True, chunksize=10, pool_size=10, adaptive=False):
         self.url = url
         self.token = token
         self.create = create
         self.verify = verify
         self.chunksize = chunksize
+        self.pool_size = pool_size
+        self.adaptive = adaptive
+        # limits used by the adaptive chunk size
+        self.max_chunksize = 500
+        self.max_payload = 1024 * 1024
+        self.target_latency = 2.0
+        self.retry = RetryPolicy(url)
+
+    @property
+    def session(self):
+        return IDBSessions.get(self.url, self.verify, self.pool_size)
 
-    # group items of an iterable into chunks of size n
-    # http://stackoverflow.com/a/434411
-    def grouper(self, iterable, n, fillvalue=None):
-        args = [iter(iterable)] * n
-        return itertools.izip_longest(*args, fillvalue=fillvalue)
+    @property
+    def state(self):
+        return SyncState.for_url(self.url)
 
     def json_machines(self, machines):
         """Converts machines list to IDB compatible json."""
-        return json.dumps({"create_machine": self.create, "machines": [x.dict() for x in machines if x != None]})
+        return '{"create_machine": %s, "machines": [%s]}' % (
+            json_value(self.create), ", ".join([x.json() for x in machines if x != None]))
 
-    def submit_machines(self, machines):
-        """Submit machines to the IDB."""
+    def tune_chunksize(self, chunksize, elapsed, payload_size):
+        """Return the chunk size to use after a chunk of chunksize machines took elapsed seconds.
 
-        logging.getLogger('idbiaas').info("Sending machines in zone %s to IDB API at %s",
-                                          self.__class__.__name__, self.url)
+        The size doubles while the IDB answers faster than half the target latency,
+        halves when it is slower than the target latency and never produces a
+        payload bigger than max_payload.
+        """
+        machine_size = max(payload_size // max(chunksize, 1), 1)
 
-        for machines_chunk in self.grouper(machines, 2):
-            json_machines = self.json_machines(machines_chunk)
+        if elapsed > self.target_latency:
+            chunksize = chunksize // 2
+        elif elapsed < self.target_latency / 2.0:
+            chunksize = chunksize * 2
 
-            req = requests.Request("PUT", self.url + "/machines", headers={
-                "X-IDB-API-Token": self.token,
-                "Content-Type": "application/json"
-            }, data=json_machines)
+        return max(min(chunksize, self.max_chunksize, self.max_payload // machine_size), 1)
 
-            prepared = req.prepare()
+    def put_machines(self, machines_chunk, json_machines):
+        """Send a single bulk PUT, returning True if the IDB accepted it.
 
+        Otherwise the status code of the response is returned, or None if there was none."""
+        req = requests.Request("PUT", self.url + "/machines", headers={
+            "X-IDB-API-Token": self.token,
+            "Content-Type": "application/json"
+        }, data=json_machines)
+
+        prepared = req.prepare()
+
+        if logging.getLogger('idbiaas').isEnabledFor(logging.DEBUG):
             logging.getLogger('idbiaas').debug("%s %s\n%s\n%s", prepared.method, prepared.url,
                                                '\n'.join('{}: {}'.format(k, v) for k, v in prepared.headers.items()),
                                                prepared.body)
 
-            s = requests.Session()
-            s.verify = self.verify
-            res = s.send(prepared)
+        start = Metrics.start()
+        res = None
+        try:
+            res = self.retry.send(self.session, prepared)
 
-            logging.getLogger('idbiaas').debug("%s\n%s", res.status_code, res.text.encode('utf-8'))
+            if logging.getLogger('idbiaas').isEnabledFor(logging.DEBUG):
+                logging.getLogger('idbiaas').debug("%s\n%s", res.status_code, res.text.encode('utf-8'))
+
+            res.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            Metrics.observe("idb_request", (("url", self.url), ("request", "bulk_put")),
+                            start, True, len(json_machines))
+            logging.getLogger('idbiaas').warn("Sending %d machines failed: %s", len(machines_chunk), e)
+            return res.status_code if res is not None else None
+
+        Metrics.observe("idb_request", (("url", self.url), ("request", "bulk_put")), start, False, len(json_machines))
+        return True
+
+    def submit_chunk(self, machines_chunk):
+        """Submit a chunk of machines, splitting it in halves if it is too big or its payload is rejected.
+
+        Returns the size of the payload for the whole chunk."""
+        json_machines = self.json_machines(machines_chunk)
+
+        if len(json_machines) <= self.max_payload or len(machines_chunk) == 1:
+            result = self.put_machines(machines_chunk, json_machines)
+            if result is True:
+                if self.state:
+                    for machine in machines_chunk:
+                        self.state.mark(machine)
+                return len(json_machines)
+
+            if len(machines_chunk) == 1:
+                logging.getLogger('idbiaas').error("Machine %s not updated!", machines_chunk[0].fqdn)
+                return len(json_machines)
+
+            # splitting only helps if a machine or the size of the payload was rejected,
+            # not e.g. for a wrong token or if the IDB is down
+            if result not in IDBv2.split_statuses:
+                logging.getLogger('idbiaas').error("%d machines not updated!", len(machines_chunk))
+                return len(json_machines)
+
+        half = len(machines_chunk) // 2
+        self.submit_chunk(machines_chunk[:half])
+        self.submit_chunk(machines_chunk[half:])
+
+        return len(json_machines)
+
+    def submit_machines(self, machines):
+        """Submit machines to the IDB in chunks of chunksize machines."""
+
+        logging.getLogger('idbiaas').info("Sending machines in zone %s to IDB API at %s",
+                                          self.__class__.__name__, self.url)
+
+        machines = iter(machines)
+        chunksize = max(self.chunksize, 1)
+        skipped = 0
+
+        while True:
+            machines_chunk = list(itertools.islice(machines, chunksize))
+            if not machines_chunk:
+                break
+
+            machines_chunk = [x for x in machines_chunk if x != None]
+            if not machines_chunk:
+                continue
+
+            # machines are submitted again in the next run
+            if self.retry.breaker.open:
+                skipped += len(machines_chunk)
+                continue
+
+            start = time.time()
+            payload_size = self.submit_chunk(machines_chunk)
+
+            if self.adaptive:
+                chunksize = self.tune_chunksize(len(machines_chunk), time.time() - start, payload_size)
+                logging.getLogger('idbiaas').debug("Using chunk size %d", chunksize)
+
+        if skipped:
+            logging.getLogger('idbiaas').error("IDB API at %s unavailable, %d machines not submitted", self.url, skipped)
 
 
 class IDBv3(object):
     """IDB API v3"""
 
+    # only report orphans, even of zones configured to delete them
+    reconcile_dry_run = False
+    # types of requests, as recorded by Metrics and limited by token_rate_limit
+    requests = ("list", "get", "post", "put", "delete")
+
     @classmethod
     def from_dict(cls,dict_config):
         create = False
         verify = True
+        pool_size = 10
+        prefetch = True
 
         if dict_config.has_key("create"):
             create = dict_config["create"]
@@ -262,115 +1941,720 @@ class IDBv3(object):
         if dict_config.has_key("verify"):
             verify = dict_config["verify"]
 
-        return IDBv3(dict_config["url"], dict_config["token"],create,verify)
+        if dict_config.has_key("pool_size"):
+            pool_size = dict_config["pool_size"]
+
+        if dict_config.has_key("prefetch"):
+            prefetch = dict_config["prefetch"]
+
+        idb = IDBv3(dict_config["url"], dict_config["token"],create,verify,pool_size,prefetch)
+
+        if dict_config.has_key("page_size"):
+            idb.page_size = dict_config["page_size"]
+
+        if dict_config.has_key("engine"):
+            if dict_config["engine"] not in ("serial", "concurrent"):
+                raise InvalidZoneConfigError("Invalid zone configuration: unknown engine " + dict_config["engine"])
+            idb.engine = dict_config["engine"]
+
+        if dict_config.has_key("inflight"):
+            idb.inflight = dict_config["inflight"]
+
+        if dict_config.has_key("rate_limit"):
+            idb.rate_limit = dict_config["rate_limit"]
+
+        if dict_config.has_key("token_rate_limit"):
+            limit = dict_config["token_rate_limit"]
+            if isinstance(limit, dict):
+                for request in limit:
+                    if request not in IDBv3.requests:
+                        raise InvalidZoneConfigError("Invalid zone configuration: unknown request " + request)
+            idb.token_rate_limit = limit
+
+        if dict_config.get("reconcile"):
+            if dict_config["reconcile"] not in ("report", "delete"):
+                raise InvalidZoneConfigError("Invalid zone configuration: unknown reconcile mode " + dict_config["reconcile"])
+            idb.reconcile = dict_config["reconcile"]
 
-    def __init__(self, url, token, create=False, verify=True):
+        if dict_config.has_key("max_delete"):
+            idb.max_delete = dict_config["max_delete"]
+
+        idb.retry = RetryPolicy.from_dict(idb.url, dict_config)
+
+        return idb
+
+    def __init__(self, url, token, create=False, verify=True, pool_size=10, prefetch=True):
         self.url = url
         self.create = create
         self.verify = verify
+        self.pool_size = pool_size
+        self.prefetch = prefetch
+        self.page_size = 100
+        # "serial" submits one machine after another, "concurrent" keeps up to inflight machines in flight
+        self.engine = "serial"
+        self.inflight = 8
+        # requests per second to this IDB url, None for no limit
+        self.rate_limit = None
+        # requests per second with each token, or a dict of requests per second by type of request
+        self.token_rate_limit = None
+        self.retry = RetryPolicy(url)
         self.multitoken = False
+        # "report" or "delete" machines which exist in the IDB but weren't crawled, None to keep them
+        self.reconcile = None
+        # orphans are only deleted if there are at most this many
+        self.max_delete = 50
+        # (machine_index, vmhosts) listed by submit_machines, reused by reconcile_machines
+        self.inventory = None
 
         # join multiple token and set multitoken flag which is checked to disable creation
         if isinstance(token, list):
+            self.tokens = token
             self.token = ",".join(token)
             self.multitoken = True
         else:
+            self.tokens = [token]
             self.token = token
 
+    @property
+    def session(self):
+        if self.engine == "concurrent":
+            # every owner token has its own pipeline, see submit_by_owner
+            return IDBSessions.get(self.url, self.verify, max(self.pool_size, self.inflight * len(self.tokens)))
+        return IDBSessions.get(self.url, self.verify, self.pool_size)
+
+    @property
+    def state(self):
+        return SyncState.for_url(self.url)
+
+    def throttle(self, token=None, request=None):
+        """Wait until the rate limits of this IDB url, and of token for the type of request, allow another request."""
+        limit = self.token_rate_limit
+        if token and isinstance(limit, dict):
+            if limit.get(request):
+                RateLimiter.get((self.url, token, request), limit[request]).acquire()
+        elif token and limit:
+            RateLimiter.get((self.url, token), limit).acquire()
+
+        if self.rate_limit:
+            RateLimiter.get(self.url, self.rate_limit).acquire()
+
+    def throttler(self, token, request):
+        """Return a function waiting for the rate limits of a request with token, for RetryPolicy.send."""
+        return lambda: self.throttle(token, request)
+
+    def machine_index(self, vmhosts=None):
+        """Return a dict mapping the fqdn of every existing machine to its owner token.
+
+        Machines are listed page by page for each token. Returns None if the IDB
+        doesn't support listing machines. If vmhosts is a dict, the vmhost of every
+        machine is stored in it.
+        """
+        index = {}
+
+        for token in self.tokens:
+            page = 1
+            while True:
+                start = Metrics.start()
+                try:
+                    prepared = self.session.prepare_request(requests.Request(
+                        "GET", self.url + "/machines", params={"page": page, "per_page": self.page_size},
+                        headers={"X-IDB-API-Token": token}))
+                    res = self.retry.send(self.session, prepared, hedge=True,
+                                          throttle=self.throttler(token, "list"))
+                    res.raise_for_status()
+                    machines = res.json()
+                    fqdns = [m["fqdn"] for m in machines]
+                    if vmhosts is not None:
+                        for m in machines:
+                            vmhosts.setdefault(m["fqdn"], m.get("vmhost"))
+                    Metrics.observe("idb_request", (("url", self.url), ("request", "list")), start)
+                except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+                    Metrics.observe("idb_request", (("url", self.url), ("request", "list")), start, True)
+                    logging.getLogger('idbiaas').warn("Can't list machines at %s, "
+                                                      "checking machines one by one: %s", self.url, e)
+                    return None
+
+                new_fqdns = [f for f in fqdns if not index.has_key(f)]
+                for fqdn in new_fqdns:
+                    index[fqdn] = token
+
+                # stop after the last page, or if the server ignores the paging parameters. A short
+                # page isn't the last one if the server caps per_page below page_size.
+                if not new_fqdns:
+                    break
+                page += 1
+
+        logging.getLogger('idbiaas').info("Found %d existing machines at %s", len(index), self.url)
+
+        return index
+
+    def machine_token(self, machine):
+        """Return the owner token of an existing machine, or None if it doesn't exist."""
+        start = Metrics.start()
+        prepared = self.session.prepare_request(requests.Request(
+            "GET", self.url + "/machines/" + machine.fqdn, headers={"X-IDB-API-Token": self.token}))
+        try:
+            res = self.retry.send(self.session, prepared, hedge=True, throttle=self.throttler(self.token, "get"))
+        except requests.exceptions.RequestException:
+            Metrics.observe("idb_request", (("url", self.url), ("request", "get")), start, True)
+            raise
+
+        try:
+            res.raise_for_status()
+        except requests.exceptions.HTTPError:
+            # a missing machine is an answer, not an error
+            Metrics.observe("idb_request", (("url", self.url), ("request", "get")), start,
+                            res.status_code != 404)
+            return None
+
+        Metrics.observe("idb_request", (("url", self.url), ("request", "get")), start)
+
+        # get the right token for this object.
+        # if the X-Idb-Api-Token header isn't set, use our own token (assuming that it is a single value).
+        t = self.token
+        try:
+            t = res.headers["X-Idb-Api-Token"]
+            logging.getLogger('idbiaas').debug("Response contained token %s" % t)
+        except:
+            pass
+
+        return t
+
+    def submit_machine(self, machine, index=None):
+        """Create or update a single machine.
+
+        index is the result of machine_index, if it is None the IDB is asked for the machine."""
+        if not machine.fqdn:
+            logging.getLogger('idbiaas').warn("machine has empty fqdn")
+
+        # machines are checked again in the next run
+        if self.retry.breaker.open:
+            return
+
+        # test if the object is existing, machines missing from the index may have been created since
+        t = None
+        if index is not None:
+            t = index.get(machine.fqdn)
+        if t is None:
+            try:
+                t = self.machine_token(machine)
+            except requests.exceptions.RequestException as e:
+                logging.getLogger('idbiaas').warn("Can't check machine %s: %s", machine.fqdn, e)
+                return
+
+        if t is None:
+            if self.create:
+                # abort if we have multiple tokens as we don't know the owner for new machines
+                if self.multitoken:
+                    logging.getLogger('idbiaas').error("Can't create machines using multiple tokens!")
+                    return
+                # machine doesn't exist but we want to create it
+                self.create_machine(self.token, machine)
+            # either we created, or want to ignore to current machine
+            return
+
+        logging.getLogger('idbiaas').debug("Using token %s" % t)
+
+        self.update_machine(t, machine)
+
     def submit_machines(self, machines):
         """Submit machines to the IDB."""
 
         logging.getLogger('idbiaas').info("Sending machines in zone %s to IDB API at %s",
                      self.__class__.__name__, self.url)
 
+        def valid(machines):
+            for machine in machines:
+                if not machine:
+                    logging.getLogger('idbiaas').warn("unexpected None in machines list")
+                    continue
+                yield machine
+
+        machines = valid(machines)
+
+        # list existing machines only if there is something to submit
+        first = next(machines, None)
+        if first is None:
+            return
+        machines = itertools.chain([first], machines)
+
+        index = None
+        if self.prefetch:
+            vmhosts = {}
+            index = self.machine_index(vmhosts)
+            if self.reconcile and index is not None:
+                self.inventory = (index, vmhosts)
+
+        if self.engine == "concurrent" and index is not None and self.multitoken:
+            self.submit_by_owner(machines, index)
+        elif self.engine == "concurrent":
+            def submit_machine(machine):
+                self.submit_machine(machine, index)
+
+            for _ in imap_bounded(submit_machine, machines, self.inflight):
+                pass
+        else:
+            for machine in machines:
+                self.submit_machine(machine, index)
+
+        if self.retry.breaker.open:
+            logging.getLogger('idbiaas').error("IDB API at %s unavailable, not all machines were submitted", self.url)
+
+    def submit_by_owner(self, machines, index):
+        """Submit machines in a pipeline for each owner token, each keeping up to inflight machines in flight.
+
+        Owners are known from index, the result of machine_index. An owner waiting
+        for its token_rate_limit doesn't hold up the machines of other owners until
+        inflight more of its machines are queued, then the crawl waits for it.
+        """
+        pipelines = {}
+
+        def submit_machine(machine):
+            self.submit_machine(machine, index)
+
+        def pipeline(queue):
+            for _ in imap_bounded(submit_machine, iter(queue.get, None), self.inflight):
+                pass
+
+        def put(owner, item):
+            queue, thread = pipelines[owner]
+            while thread.is_alive():
+                try:
+                    queue.put(item, timeout=1)
+                    return
+                except Queue.Full:
+                    pass
+
         for machine in machines:
-            if not machine:
-                logging.getLogger('idbiaas').warn("unexpected None in machines list")
+            # new machines share the pipeline of the owner None
+            owner = index.get(machine.fqdn)
+            if not pipelines.has_key(owner):
+                queue = Queue.Queue(max(self.inflight, 1))
+                thread = threading.Thread(target=pipeline, args=(queue,))
+                thread.daemon = True
+                thread.start()
+                pipelines[owner] = (queue, thread)
+            put(owner, machine)
+
+        for owner in pipelines:
+            put(owner, None)
+        for queue, thread in pipelines.values():
+            # Thread.join without timeout can't be interrupted by ctrl-c on python 2
+            while thread.is_alive():
+                thread.join(60)
+
+        logging.getLogger('idbiaas').debug("Submitted machines of %d owners to %s", len(pipelines), self.url)
+
+    def reconcile_machines(self, crawled, hosts, disappeared=()):
+        """Report or delete the machines which exist in the IDB but weren't crawled.
+
+        crawled holds the fqdns crawled by all zones of this url, see Reconciler. A
+        machine is an orphan if it runs on one of hosts, or a zone submitted it before
+        (disappeared), but wasn't crawled. Orphans are only deleted if there are at most
+        max_delete of them. Returns the number of orphans and of deleted machines.
+        """
+        if self.inventory:
+            index, vmhosts = self.inventory
+        else:
+            vmhosts = {}
+            index = self.machine_index(vmhosts)
+        self.inventory = None
+
+        if index is None:
+            logging.getLogger('idbiaas').warn("Can't list machines at %s, not reconciling", self.url)
+            return 0, 0
+
+        hosts = set(h for h in hosts if h)
+        disappeared = set(disappeared)
+        orphans = sorted(f for f in index if f not in crawled
+                         and (vmhosts.get(f) in hosts or f in disappeared))
+
+        for fqdn in orphans:
+            logging.getLogger('idbiaas').info("Machine %s at %s is an orphan", fqdn, self.url)
+
+        if not orphans or self.reconcile != "delete" or IDBv3.reconcile_dry_run:
+            return len(orphans), 0
+
+        if len(orphans) > self.max_delete:
+            logging.getLogger('idbiaas').error("Not deleting %d orphans at %s, more than max_delete %d",
+                                               len(orphans), self.url, self.max_delete)
+            return len(orphans), 0
 
-            if not machine.fqdn:
-                logging.getLogger('idbiaas').warn("machine has empty fqdn")
+        def delete_machine(fqdn):
+            return self.delete_machine(index[fqdn], fqdn)
 
-            json_machine = machine.dict_v3()
+        deleted = len([x for x in imap_bounded(delete_machine, orphans, self.inflight) if x])
+        return len(orphans), deleted
 
-            # test if the object is existing
-            s = requests.Session()
-            s.verify = self.verify
+    def delete_machine(self, token, fqdn):
+        """Delete a machine from the IDB, returning True if it is gone."""
+        if self.retry.breaker.open:
+            return False
+
+        prepared = self.session.prepare_request(requests.Request(
+            "DELETE", self.url + "/machines/" + fqdn, headers={"X-IDB-API-Token": token}))
 
-            res = s.get(self.url + "/machines/" + machine.fqdn, headers={
-                               "X-IDB-API-Token": self.token})
+        logging.getLogger('idbiaas').info("Deleting machine %s" % fqdn)
+
+        start = Metrics.start()
+        try:
+            res = self.retry.send(self.session, prepared, throttle=self.throttler(token, "delete"))
+        except requests.exceptions.RequestException as e:
+            Metrics.observe("idb_request", (("url", self.url), ("request", "delete")), start, True)
+            logging.getLogger('idbiaas').warn("Machine %s not deleted: %s", fqdn, e)
+            return False
 
+        # a machine deleted by someone else is gone as well
+        if res.status_code != 404:
             try:
                 res.raise_for_status()
             except requests.exceptions.HTTPError:
-                if self.create:
-                    # abort if we have multiple tokens as we don't know the owner for new machines
-                    if self.multitoken:
-                        logging.getLogger('idbiaas').error("Can't create machines using multiple tokens!")
-                        continue
-                    # machine doesn't exist but we want to create it
-                    self.create_machine(self.token, machine)
-                # either we created, or want to ignore to current machine, skip to next one
-                continue
-
-            # get the right token for this object.
-            # if the X-Idb-Api-Token header isn't set, use our own token (assuming that it is a single value).
-            t = self.token
-            try:
-                t = res.headers["X-Idb-Api-Token"]
-                logging.getLogger('idbiaas').debug("Response contained token %s" % t)
-            except:
-                pass
-
-            logging.getLogger('idbiaas').debug("Using token %s" % t)
+                Metrics.observe("idb_request", (("url", self.url), ("request", "delete")), start, True)
+                logging.getLogger('idbiaas').warn("Machine %s not deleted!" % fqdn)
+                return False
 
-            self.update_machine(t, machine)
+        Metrics.observe("idb_request", (("url", self.url), ("request", "delete")), start)
+        return True
 
     def create_machine(self, token, machine):
         """Create a machine in the IDB."""
         req = requests.Request("POST", self.url + "/machines", headers={
             "X-IDB-API-Token": token,
             "Content-Type": "application/json"
-        }, data=json.dumps(machine.dict_v3()))
+        }, data=machine.json(v3=True))
 
         logging.getLogger('idbiaas').info("Creating machine %s" % machine.fqdn)
 
         prepared = req.prepare()
 
-        logging.getLogger('idbiaas').debug("{} {}\n{}\n{}".format(prepared.method, prepared.url,
-                                            '\n'.join('{}: {}'.format(k, v) for k, v in prepared.headers.items()),
-                                            prepared.body))
+        if logging.getLogger('idbiaas').isEnabledFor(logging.DEBUG):
+            logging.getLogger('idbiaas').debug("{} {}\n{}\n{}".format(prepared.method, prepared.url,
+                                                '\n'.join('{}: {}'.format(k, v) for k, v in prepared.headers.items()),
+                                                prepared.body))
+
+        start = Metrics.start()
+        try:
+            res = self.retry.send(self.session, prepared, idempotent=False, throttle=self.throttler(token, "post"))
+        except requests.exceptions.RequestException as e:
+            Metrics.observe("idb_request", (("url", self.url), ("request", "post")), start, True, len(prepared.body))
+            logging.getLogger('idbiaas').warn("Machine %s not created: %s", machine.fqdn, e)
+            return
+
+        if logging.getLogger('idbiaas').isEnabledFor(logging.DEBUG):
+            logging.getLogger('idbiaas').debug("%s\n%s", res.status_code, res.text.encode('utf-8'))
+
+        try:
+            res.raise_for_status()
+        except:
+            Metrics.observe("idb_request", (("url", self.url), ("request", "post")), start, True, len(prepared.body))
+            logging.getLogger('idbiaas').warn("Machine %s not created!" % machine.fqdn)
+            return
 
-        s = requests.Session()
-        s.verify = self.verify
-        res = s.send(prepared)
+        Metrics.observe("idb_request", (("url", self.url), ("request", "post")), start, False, len(prepared.body))
 
-        logging.getLogger('idbiaas').debug("%s\n%s", res.status_code, res.text.encode('utf-8'))
+        if self.state:
+            self.state.mark(machine)
 
     def update_machine(self, token, machine):
         """Update machine data in the IDB."""
         req = requests.Request("PUT", self.url + "/machines/" + machine.fqdn, headers={
             "X-IDB-API-Token": token,
             "Content-Type": "application/json"
-        }, data=json.dumps(machine.dict_v3()))
+        }, data=machine.json(v3=True))
 
         logging.getLogger('idbiaas').info("Updating machine %s" % machine.fqdn)
 
         prepared = req.prepare()
 
-        logging.getLogger('idbiaas').debug("{} {}\n{}\n{}".format(prepared.method, prepared.url,
-                                            '\n'.join('{}: {}'.format(k, v) for k, v in prepared.headers.items()),
-                                            prepared.body))
+        if logging.getLogger('idbiaas').isEnabledFor(logging.DEBUG):
+            logging.getLogger('idbiaas').debug("{} {}\n{}\n{}".format(prepared.method, prepared.url,
+                                                '\n'.join('{}: {}'.format(k, v) for k, v in prepared.headers.items()),
+                                                prepared.body))
 
-        s = requests.Session()
-        s.verify = self.verify
-        res = s.send(prepared)
+        start = Metrics.start()
+        try:
+            res = self.retry.send(self.session, prepared, throttle=self.throttler(token, "put"))
+        except requests.exceptions.RequestException as e:
+            Metrics.observe("idb_request", (("url", self.url), ("request", "put")), start, True, len(prepared.body))
+            logging.getLogger('idbiaas').warn("Machine %s not updated: %s", machine.fqdn, e)
+            return
 
-        logging.getLogger('idbiaas').debug("%s\n%s", res.status_code, res.text.encode('utf-8'))
+        if logging.getLogger('idbiaas').isEnabledFor(logging.DEBUG):
+            logging.getLogger('idbiaas').debug("%s\n%s", res.status_code, res.text.encode('utf-8'))
 
         try:
             res.raise_for_status()
         except:
+            Metrics.observe("idb_request", (("url", self.url), ("request", "put")), start, True, len(prepared.body))
             logging.getLogger('idbiaas').warn("Machine %s not updated!" % machine.fqdn)
+            return
+
+        Metrics.observe("idb_request", (("url", self.url), ("request", "put")), start, False, len(prepared.body))
+
+        if self.state:
+            self.state.mark(machine)
+
+
+class ConfigCache(object):
+    """Configurations fetched from the IDB, kept in local json files.
+
+    A cached configuration younger than max_age seconds is used without asking the
+    IDB, older ones are revalidated with If-None-Match and If-Modified-Since. If the
+    IDB can't be reached the cached configuration is used, however old it is.
+    Nothing is cached while directory is None. The configurations carry credentials,
+    so the directory and the files are only readable by the owner.
+    """
+
+    directory = None
+    max_age = 0
+    # seconds to connect and to wait for the configuration
+    timeout = (10, 30)
+
+    @classmethod
+    def path(cls, url, token, name=""):
+        # the token is part of the name as different tokens may see different configurations
+        return os.path.join(cls.directory, hashlib.sha1(url + "\0" + token + "\0" + name).hexdigest() + ".json")
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            logging.getLogger('idbiaas').info("No cached config in %s: %s", path, e)
+            return None
+
+    @classmethod
+    def save(cls, path, entry):
+        try:
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0700)
+            os.chmod(directory, 0700)
+            if os.path.exists(path + ".tmp"):
+                os.unlink(path + ".tmp")
+            with os.fdopen(os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600), "w") as f:
+                json.dump(entry, f)
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError) as e:
+            logging.getLogger('idbiaas').error("Can't cache config in %s: %s", path, e)
+
+    @classmethod
+    def fetch(cls, base_url, path, token, verify, transform, name=""):
+        """Return transform applied to the json at base_url + path, from the cache if it didn't change.
+
+        name tells apart what different transforms keep of the same url.
+        """
+        session = IDBSessions.get(base_url, verify)
+        url = base_url + path
+        headers = {"X-IDB-API-Token": token}
+
+        if cls.directory is None:
+            res = session.get(url, headers=headers, timeout=cls.timeout)
+            res.raise_for_status()
+            return transform(res.json())
+
+        path = cls.path(url, token, name)
+        entry = cls.load(path)
+
+        if entry:
+            if time.time() - entry["fetched"] < cls.max_age:
+                logging.getLogger('idbiaas').info("Using cached config for %s", url)
+                return entry["data"]
+
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            res = session.get(url, headers=headers, timeout=cls.timeout)
+            if res.status_code == 304 and entry:
+                logging.getLogger('idbiaas').info("Config for %s not modified", url)
+                entry["fetched"] = time.time()
+            else:
+                res.raise_for_status()
+                entry = {"url": url, "etag": res.headers.get("ETag"), "last_modified": res.headers.get("Last-Modified"),
+                         "fetched": time.time(), "data": transform(res.json())}
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+            if not entry:
+                raise
+            logging.getLogger('idbiaas').warn("Can't fetch config from %s, using the cached config from %s: %s",
+                                              url, time.ctime(entry["fetched"]), e)
+            return entry["data"]
+
+        cls.save(path, entry)
+        return entry["data"]
+
+
+class Snapshot(object):
+    """Crawl results stored as gzip compressed json lines, written and read as streams.
+
+    The first line identifies the file. It is followed by a line for every crawled
+    machine with the key of its zone, and a line for every zone once it is crawled
+    telling whether it was crawled completely. Zones are matched by their key, so a
+    snapshot can be submitted with any configuration using the same drivers.
+    """
+
+    format = "idbiaas-snapshot"
+    version = 1
+
+    @classmethod
+    def export(cls, path, zones, concurrency=4, complete=True):
+        """Crawl up to concurrency zones at once into a snapshot at path, returning a summary.
+
+        Zones are only recorded as complete if complete is set, e.g. not for a shard."""
+        lock = threading.Lock()
+
+        def crawl_zone(zone):
+            count = 0
+            for machine in zone.machines():
+                line = '{"zone": %s, "machine": %s}\n' % (encode_string(zone.key), machine.json())
+                with lock:
+                    f.write(line)
+                count += 1
+
+            line = json.dumps({"zone": zone.key, "machines": count, "complete": zone.complete and complete})
+            with lock:
+                f.write(line + "\n")
+            return count
+
+        summary = {"zones": 0, "failed_zones": 0, "machines": 0}
+
+        f = gzip.open(path + ".tmp", "wb")
+        try:
+            f.write(json.dumps({"format": cls.format, "version": cls.version, "time": time.time()}) + "\n")
+            for count in map_bounded(crawl_zone, zones, concurrency):
+                if count is None:
+                    summary["failed_zones"] += 1
+                else:
+                    summary["zones"] += 1
+                    summary["machines"] += count
+        finally:
+            f.close()
+
+        os.rename(path + ".tmp", path)
+
+        return summary
+
+    @classmethod
+    def read(cls, path):
+        """Yield the entries of a snapshot, after checking its first line."""
+        f = gzip.open(path, "rb")
+        try:
+            header = json.loads(f.readline() or "null")
+            if not isinstance(header, dict) or header.get("format") != cls.format:
+                raise InvalidSnapshotError("%s is not a snapshot" % path)
+            if header.get("version") != cls.version:
+                raise InvalidSnapshotError("Unsupported snapshot version %s in %s" % (header.get("version"), path))
+
+            for line in f:
+                yield json.loads(line)
+        finally:
+            f.close()
+
+
+class SnapshotZone(Zone):
+    """A zone whose machines are read from a snapshot instead of crawled.
+
+    The snapshot is streamed once for every zone, up to the end of the zone. A zone
+    missing from the snapshot, or whose end is missing, is incomplete.
+    """
+
+    def __init__(self, zone, path):
+        self.zone = zone
+        self.path = path
+        self.idb = zone.idb
+        self.key = zone.key
+        self.interval = zone.interval
+
+    def machines(self):
+        self.complete = False
+        try:
+            for entry in Snapshot.read(self.path):
+                if entry["zone"] != self.key:
+                    continue
+                if not entry.has_key("machine"):
+                    self.complete = entry["complete"]
+                    return
+                yield IDBMachine.from_dict(entry["machine"])
+        except (IOError, EOFError, ValueError, KeyError, InvalidSnapshotError) as e:
+            logging.getLogger('idbiaas').error("SnapshotZone: can't read %s: %s", self.path, e)
+            return
+
+        logging.getLogger('idbiaas').warn("SnapshotZone: zone %s missing or incomplete in %s", self.key, self.path)
+
+
+class Reconciler(object):
+    """Reconciles each IDB url once every zone submitting to it was crawled.
+
+    Orphans are looked for on the hosts and in the disappeared machines of the zones
+    configured to reconcile, but a machine crawled by any zone of the url is kept,
+    e.g. after it moved to a host of another zone. A url is only reconciled if all of
+    its zones were crawled completely since its last reconcile. Machines crawled
+    before the last reconcile are kept as well, as zones with their own intervals
+    crawl at different times. The first zone of a url configured to reconcile
+    provides the IDB settings.
+
+    Nothing is reconciled if zones are only a part of the configuration, e.g. the
+    zones of a shard, as complete is False then.
+    """
+
+    def __init__(self, zones, complete=True):
+        self.lock = threading.Lock()
+        # url -> keys of all zones, for urls with a zone configured to reconcile
+        self.zones = {}
+        urls = set(zone.idb.url for zone in zones if zone.idb.reconcile)
+        if urls and not complete:
+            logging.getLogger('idbiaas').warn("Only a part of the zones is crawled, not reconciling")
+            urls = set()
+        for zone in zones:
+            if zone.idb.url in urls:
+                self.zones.setdefault(zone.idb.url, set()).add(zone.key)
+
+        # url -> state of the current window, see add
+        self.windows = {}
+        # url -> fqdns crawled in the previous window
+        self.previous = {}
+
+    def wants(self, zone):
+        """Return True if the crawled machines of zone are needed."""
+        return self.zones.has_key(zone.idb.url)
+
+    def add(self, zone, crawled, complete, disappeared=()):
+        """Record the crawl of a zone, reconciling its url if it was the last zone of the url.
+
+        crawled maps the fqdns of the crawled machines to their vmhosts. Returns the
+        number of orphans and of deleted machines."""
+        url = zone.idb.url
+        with self.lock:
+            window = self.windows.setdefault(url, {"reported": {}, "crawled": set(), "hosts": set(),
+                                                    "disappeared": set(), "idbs": []})
+            window["reported"][zone.key] = window["reported"].get(zone.key, True) and complete
+            window["crawled"].update(crawled)
+            window["idbs"].append(zone.idb)
+            if zone.idb.reconcile:
+                window["hosts"].update(crawled.values())
+                window["disappeared"].update(disappeared)
+
+            if set(window["reported"]) != self.zones[url]:
+                return 0, 0
+
+            del self.windows[url]
+            previous = self.previous.get(url, set())
+            self.previous[url] = window["crawled"]
+
+        idbs = [idb for idb in window["idbs"] if idb.reconcile]
+        try:
+            if not all(window["reported"].values()):
+                # a failed host or page would make its machines look like orphans
+                logging.getLogger('idbiaas').warn("Not all zones of %s were crawled completely, not reconciling", url)
+                return 0, 0
+
+            return idbs[0].reconcile_machines(window["crawled"] | previous, window["hosts"], window["disappeared"])
+        finally:
+            for idb in window["idbs"]:
+                idb.inventory = None
 
 
 class IDBIaas(object):
@@ -378,22 +2662,20 @@ class IDBIaas(object):
     @classmethod
     def v2_url_config(cls, url, token, name, verify):
         """Load config for this adapter from the idb (API v2)."""
-        res = requests.get(url + "/cloud_providers",
-                           headers={"X-IDB-API-Token": token}, verify=verify)
-        res.raise_for_status()
-        for c in res.json():
-            if c["name"] == name:
-                return json.loads(c["config"])
+        def config(providers):
+            # only this adapter's config is cached, not the credentials of the others
+            for provider in providers:
+                if provider["name"] == name:
+                    return provider["config"]
+            raise Exception('No config named "{}" found.'.format(name))
 
-        raise 'No config named "{}" found.'.format(name)
+        return json.loads(ConfigCache.fetch(url, "/cloud_providers", token, verify, config, name))
 
     @classmethod
     def v3_url_config(cls, url, token, name, verify):
         """Load config for this adapter from the idb (API v3)"""
-        res = requests.get(url + "/cloud_providers/" + name,
-                           headers={"X-IDB-API-Token": token}, verify=verify)
-        res.raise_for_status()
-        return json.loads(res.json()["config"])
+        return json.loads(ConfigCache.fetch(url, "/cloud_providers/" + name, token, verify,
+                                            lambda provider: provider["config"]))
 
     @classmethod
     def file_config(cls, fil):
@@ -403,28 +2685,329 @@ class IDBIaas(object):
 
     @classmethod
     def zones_from_dict(cls, dict_config):
-        """Create zones from dict configuration."""
+        """Create zones from dict configuration.
+
+        The same driver may feed several IDB urls, but only once each, as the sync
+        state of an IDB url keeps the machines of its zones by zone key.
+        """
         zones = []
+        seen = set()
         for zone in dict_config["zones"]:
-            zones.append(Zone.from_dict(zone))
+            zone = Zone.from_dict(zone)
+            if (zone.key, zone.idb.url) in seen:
+                raise InvalidZoneConfigError("Invalid zone configuration: zone {} listed twice for {}".format(
+                    zone.key, zone.idb.url))
+            seen.add((zone.key, zone.idb.url))
+            zones.append(zone)
 
         return zones
 
     @classmethod
-    def run_zones(cls, zones):
-        for zone in zones:
-            machines = zone.machines()
+    def run_zones(cls, zones, concurrency=4, idb_concurrency=16, buffer_size=1000, reconciler=None):
+        """Crawl up to concurrency zones at once, streaming their machines into the IDB while crawling.
+
+        Up to buffer_size machines of a zone are crawled ahead of its submission.
+        At most idb_concurrency requests are in flight to the same IDB url, whichever
+        zones send them, so a slowly crawled zone doesn't keep the others of its IDB
+        waiting. IDB urls are reconciled by reconciler, by default once all of their
+        zones in zones ran.
+        """
+        if reconciler is None:
+            reconciler = Reconciler(zones)
+
+        for url in set(zone.idb.url for zone in zones):
+            InflightLimiter.set(url, idb_concurrency)
+
+        def found(zone, counts, crawled):
             logging.getLogger('idbiaas').info("Found machines in zone %s:", zone.__class__.__name__)
+            start = Metrics.start()
+            error = True
+            try:
+                for machine in zone.machines():
+                    logging.getLogger('idbiaas').info(machine.fqdn)
+                    counts["machines"] += 1
+                    if crawled is not None:
+                        crawled[machine.fqdn] = machine.vmhost
+                    yield machine
+                error = False
+            finally:
+                if start is not None:
+                    Metrics.observe("zone_crawl", (("zone", zone.key), ("type", zone.__class__.__name__)),
+                                    start, error, counts["machines"])
+
+        def submitted(machines, counts):
             for machine in machines:
-                logging.getLogger('idbiaas').info(machine.fqdn)
+                counts["submitted"] += 1
+                yield machine
+
+        def survived(zone, machines, failure):
+            # the machines crawled before a failure are still submitted
+            try:
+                for machine in machines:
+                    yield machine
+            except Exception as e:
+                logging.getLogger('idbiaas').error("Crawling zone %s failed: %s", zone.__class__.__name__, e)
+                failure.append(e)
+
+        def run_zone(zone):
+            start = Metrics.start()
+            counts = {"zones": 1, "failed_zones": 0, "machines": 0, "submitted": 0, "disappeared": 0,
+                      "orphans": 0, "deleted": 0}
+            # fqdn -> vmhost of the crawled machines, only needed to reconcile
+            crawled = {} if reconciler.wants(zone) else None
+            failure = []
+            machines = survived(zone, buffered(found(zone, counts, crawled), buffer_size), failure)
+
+            state = zone.idb.state
+            if state:
+                machines = state.filter(zone.key, machines)
+
+            machines = submitted(machines, counts)
             zone.idb.submit_machines(machines)
 
+            # machines of a failed host or page, or after a failed crawl, didn't disappear
+            complete = zone.complete and not failure
+            counts["failed_zones"] = len(failure)
+            disappeared = []
+            if state and complete:
+                disappeared = state.disappeared(zone.key)
+            elif state:
+                state.forget_seen(zone.key)
+            for fqdn in disappeared:
+                counts["disappeared"] += 1
+                logging.getLogger('idbiaas').info("Machine %s disappeared from zone %s",
+                                                  fqdn, zone.__class__.__name__)
+
+            if crawled is not None:
+                counts["orphans"], counts["deleted"] = reconciler.add(zone, crawled, complete, disappeared)
+
+            if start is not None:
+                Metrics.observe("zone_run", (("zone", zone.key), ("type", zone.__class__.__name__)),
+                                start, bool(failure), counts["submitted"])
+            return counts
+
+        summary = {"zones": 0, "failed_zones": 0, "machines": 0, "submitted": 0, "disappeared": 0,
+                   "orphans": 0, "deleted": 0}
+        for counts in map_bounded(run_zone, zones, concurrency):
+            if counts is None:
+                summary["failed_zones"] += 1
+                continue
+            for key, value in counts.items():
+                summary[key] += value
+
+        return summary
+
+    def run_options(self):
+        """Return the run_zones arguments set in the config."""
+        options = {}
+
+        for key in ("concurrency", "idb_concurrency", "buffer_size"):
+            if self.config.has_key(key):
+                options[key] = self.config[key]
+
+        return options
+
+    def zones(self, config):
+        """Create the zones of config, keeping only the part crawled by this shard."""
+        zones = IDBIaas.zones_from_dict(config)
+
+        if self.shard:
+            index, count = self.shard
+            zones = [z for z in (zone.shard(index, count) for zone in zones) if z is not None]
+            logging.getLogger('idbiaas').info("Crawling %d zones as shard %d/%d", len(zones), index, count)
+
+        if self.snapshot:
+            zones = [SnapshotZone(zone, self.snapshot) for zone in zones]
+
+        return zones
+
     def run(self):
-        zones = IDBIaas.zones_from_dict(self.config)
-        self.run_zones(zones)
+        """Run all zones once, returning a summary of the run."""
+        start = time.time()
+        zones = self.zones(self.config)
+        summary = self.run_zones(zones, reconciler=Reconciler(zones, self.shard is None), **self.run_options())
+        summary["seconds"] = time.time() - start
+
+        SyncState.save_all()
+        Metrics.write()
+        Trace.write()
+
+        logging.getLogger('idbiaas').info("Run summary: %s", json.dumps(summary, sort_keys=True))
+        return summary
+
+    def export(self, path):
+        """Crawl all zones once into a snapshot at path instead of submitting them, returning a summary."""
+        start = time.time()
+        # a shard's crawl of a zone is never complete
+        summary = Snapshot.export(path, self.zones(self.config), self.run_options().get("concurrency", 4),
+                                  self.shard is None)
+        summary["seconds"] = time.time() - start
+
+        Metrics.write()
+        Trace.write()
+
+        logging.getLogger('idbiaas').info("Snapshot summary: %s", json.dumps(summary, sort_keys=True))
+        return summary
+
+    def run_processes(self, count):
+        """Run the zones in count worker processes, each crawling a shard, returning the summed summary.
+
+        If this run is a shard itself, it is split again into count shards."""
+        start = time.time()
+        index, total = self.shard or (0, 1)
+        shards = [(index * count + i, total * count) for i in range(count)]
+
+        # the workers must not share connections with this process
+        IDBSessions.close()
+        DriverCache.close()
+
+        pool = multiprocessing.Pool(count)
+        try:
+            results = pool.map(run_shard, [(self.config, shard) for shard in shards])
+        finally:
+            pool.close()
+            pool.join()
+
+        summary = {}
+        for shard, (shard_summary, metrics, trace) in zip(shards, results):
+            logging.getLogger('idbiaas').info("Shard %d/%d summary: %s", shard[0], shard[1],
+                                              json.dumps(shard_summary, sort_keys=True))
+            for key, value in shard_summary.items():
+                summary[key] = summary.get(key, 0) + value
+            Metrics.merge(metrics)
+            Trace.merge(trace)
+
+        summary["seconds"] = time.time() - start
+        Metrics.write()
+        Trace.write()
+
+        logging.getLogger('idbiaas').info("Run summary: %s", json.dumps(summary, sort_keys=True))
+        return summary
+
+    def run_daemon(self, load_config, interval=300, reload_interval=300, stop=None):
+        """Run every zone each interval seconds (or its own "interval") until stop is set.
+
+        Every zone runs on its own schedule in its own worker, so a slow zone doesn't
+        delay the others; at most "concurrency" zones run at once. load_config is
+        called every reload_interval seconds, zones are only rebuilt if the returned
+        config differs from the current one. libvirt connections and libcloud drivers
+        are kept in the DriverCache between runs.
+        """
+        stop = stop or threading.Event()
+        config_hash = None
+        next_reload = 0
+        # the zones by (zone key, IDB url) and their reconciler, replaced when the config changes
+        current = {"zones": {}, "reconciler": Reconciler([]), "slots": None}
+        # (zone key, IDB url) -> (worker thread, event halting it)
+        workers = {}
+        # the state, metrics and trace files are written by one worker at a time
+        saving = threading.Lock()
+
+        def worker(key, halt):
+            while not halt.is_set():
+                zone = current["zones"].get(key)
+                if zone is None:
+                    return
+
+                with current["slots"]:
+                    if halt.is_set():
+                        return
+                    logging.getLogger('idbiaas').info("Running zone %s for %s", *key)
+                    try:
+                        self.run_zones([zone], reconciler=current["reconciler"], **self.run_options())
+                    except Exception as e:
+                        # the zone is tried again on its next run
+                        logging.getLogger('idbiaas').exception("Running zone %s for %s failed: %s", key[0], key[1], e)
+
+                with saving:
+                    SyncState.save_all()
+                    Metrics.write()
+                    Trace.write()
+                    DriverCache.evict_idle()
+                    gc.collect()
+                    logging.getLogger('idbiaas').info("Maximum resident memory: %d kB",
+                                                      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+                halt.wait(zone.interval or interval)
 
-    def __init__(self, config):
+        try:
+            while not stop.is_set():
+                if time.time() >= next_reload:
+                    next_reload = time.time() + reload_interval
+                    try:
+                        config = load_config()
+                        new_hash = hashlib.sha1(json.dumps(config, sort_keys=True)).hexdigest()
+                        if new_hash != config_hash:
+                            logging.getLogger('idbiaas').info("Loading changed config")
+                            zones = self.zones(config)
+                            self.config = config
+                            config_hash = new_hash
+                            # workers of zones which didn't change keep their schedule and run the new zone next
+                            current["zones"] = dict(((z.key, z.idb.url), z) for z in zones)
+                            current["reconciler"] = Reconciler(zones, self.shard is None)
+                            current["slots"] = threading.BoundedSemaphore(
+                                max(self.run_options().get("concurrency", 4), 1))
+
+                            for key in workers.keys():
+                                if not current["zones"].has_key(key):
+                                    workers.pop(key)[1].set()
+                            for key in current["zones"]:
+                                if not workers.has_key(key):
+                                    halt = threading.Event()
+                                    t = threading.Thread(target=worker, args=(key, halt))
+                                    t.daemon = True
+                                    t.start()
+                                    workers[key] = (t, halt)
+                    except Exception as e:
+                        logging.getLogger('idbiaas').error("Can't load config, keeping the current one: %s", e)
+
+                stop.wait(max(next_reload - time.time(), 0))
+        finally:
+            for t, halt in workers.values():
+                halt.set()
+            # let running zones finish
+            for t, halt in workers.values():
+                t.join()
+
+    def __init__(self, config, shard=None, snapshot=None):
         self.config = config
+        # (index, count) to only crawl shard index of count shards
+        self.shard = shard
+        # path of a snapshot to read the machines of all zones from instead of crawling them
+        self.snapshot = snapshot
+
+
+def run_shard(args):
+    """Run a shard of config in a worker process of IDBIaas.run_processes."""
+    config, shard = args
+
+    SyncState.shard = shard
+    # the parent process writes the merged metrics and trace
+    Metrics.reset()
+    Metrics.json_path = None
+    Metrics.textfile_path = None
+    Trace.reset()
+    Trace.path = None
+
+    summary = IDBIaas(config, shard).run()
+
+    IDBSessions.close()
+    DriverCache.close()
+
+    return summary, Metrics.snapshot(), Trace.snapshot()
+
+
+def shard_arg(value):
+    """Parse a shard given as "index/count", index counting from 0."""
+    try:
+        index, count = [int(x) for x in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be index/count, e.g. 0/4")
+
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError("shard index must be between 0 and count - 1")
+
+    return index, count
 
 
 def main():
@@ -468,6 +3051,72 @@ def main():
                         action='store_false',
                         help="Don't verify SSL certificate chain when retrieving config")
 
+    parser.add_argument('--state-dir', type=str,
+                        help="Directory keeping the state of previous runs, used to skip unchanged machines",
+                        default=appdirs.user_cache_dir("idbiaas"))
+
+    parser.add_argument('--config-max-age', type=int,
+                        help="Use the config cached in --state-dir without asking the IDB if it is younger than "
+                             "this many seconds",
+                        default=0)
+
+    parser.add_argument('--state-ttl', type=int,
+                        help="Resubmit unchanged machines after this many seconds",
+                        default=86400)
+
+    parser.add_argument('--full-resync',
+                        action='store_true',
+                        help="Submit all machines, even if they didn't change since the last run")
+
+    parser.add_argument('--reconcile-dry-run',
+                        action='store_true',
+                        help="Only report orphan machines, even of zones configured to delete them")
+
+    parser.add_argument('--daemon',
+                        action='store_true',
+                        help="Keep running and sync every zone each --interval seconds")
+
+    parser.add_argument('--interval', type=int,
+                        help="Seconds between syncs of a zone in daemon mode, unless the zone sets \"interval\"",
+                        default=300)
+
+    parser.add_argument('--reload-interval', type=int,
+                        help="Seconds between checks for a changed config in daemon mode",
+                        default=300)
+
+    parser.add_argument('--shard', type=shard_arg,
+                        help="Only crawl the libvirt hosts and other zones of shard index/count, e.g. 0/4, "
+                             "to spread a run over several nodes",
+                        default=None)
+
+    parser.add_argument('--processes', type=int,
+                        help="Spread the run over this many worker processes, each crawling a shard",
+                        default=1)
+
+    snapshot_group = parser.add_mutually_exclusive_group()
+
+    snapshot_group.add_argument('--export-snapshot', metavar='FILE',
+                                help="Write the crawled machines to a snapshot file instead of submitting them")
+
+    snapshot_group.add_argument('--import-snapshot', metavar='FILE',
+                                help="Submit the machines of a snapshot file instead of crawling the zones")
+
+    parser.add_argument('--metrics-json', type=str,
+                        help="Write timings, counts and errors of crawls and IDB requests to this json file",
+                        default=None)
+
+    parser.add_argument('--metrics-textfile', type=str,
+                        help="Write the metrics to this file in the Prometheus text format",
+                        default=None)
+
+    parser.add_argument('--trace-spans', type=str, metavar='FILE',
+                        help="Write spans of zones, hosts and IDB requests to this file as a Chrome trace",
+                        default=None)
+
+    parser.add_argument('--profile', type=str, metavar='FILE',
+                        help="Profile all threads with cProfile and write the statistics to this file",
+                        default=None)
+
     parser.add_argument('--syslog', type=str,
                         help="Syslog address, see https://docs.python.org/2/library/logging.handlers.html#sysloghandler",
                         default="/dev/log")
@@ -507,26 +3156,85 @@ def main():
 
     args = parser.parse_args()
 
+    if args.daemon and args.processes > 1:
+        parser.error("--processes can't be used with --daemon, run a daemon per --shard instead")
+
+    if (args.export_snapshot or args.import_snapshot) and (args.daemon or args.processes > 1):
+        parser.error("snapshots can't be used with --daemon or --processes")
+
+    if args.import_snapshot and args.shard:
+        parser.error("--import-snapshot can't be used with --shard")
+
+    if args.profile and args.processes > 1:
+        parser.error("--profile can't be used with --processes, profile a single --shard instead")
+
     logger = logging.getLogger("idbiaas")
     logger.setLevel(args.loglevel)
     logger.addHandler(logging.handlers.SysLogHandler(address = args.syslog))
 
-    config = None
-    if args.v3_url:
-        logger.info("Fetching config from %s", args.v3_url)
-        config = IDBIaas.v3_url_config(args.v3_url, args.token, args.config_name, args.verify)
-    elif args.v2_url:
-        logger.info("Fetching config from %s", args.v2_url)
-        config = IDBIaas.v2_url_config(args.v2_url, args.token, args.config_name, args.verify)
-    elif args.config:
-        logger.info("Using config file %s", args.config.name)
-        config = IDBIaas.file_config(args.config)
-    else:
+    SyncState.directory = args.state_dir
+    SyncState.ttl = args.state_ttl
+    SyncState.full_resync = args.full_resync
+    SyncState.shard = args.shard
+    IDBv3.reconcile_dry_run = args.reconcile_dry_run
+
+    ConfigCache.directory = os.path.join(args.state_dir, "config")
+    ConfigCache.max_age = args.config_max_age
+
+    Metrics.json_path = args.metrics_json
+    Metrics.textfile_path = args.metrics_textfile
+    Metrics.enabled = bool(args.metrics_json or args.metrics_textfile)
+
+    Trace.path = args.trace_spans
+    Trace.enabled = bool(args.trace_spans)
+
+    def load_config():
+        if args.v3_url:
+            logger.info("Fetching config from %s", args.v3_url)
+            return IDBIaas.v3_url_config(args.v3_url, args.token, args.config_name, args.verify)
+        elif args.v2_url:
+            logger.info("Fetching config from %s", args.v2_url)
+            return IDBIaas.v2_url_config(args.v2_url, args.token, args.config_name, args.verify)
+        elif args.config:
+            logger.info("Using config file %s", args.config.name)
+            with open(args.config.name) as f:
+                return IDBIaas.file_config(f)
+
+    if not (args.v3_url or args.v2_url or args.config):
         logger.critical("No url or file config.")
         return
 
-    idbiaas = IDBIaas(config)
-    idbiaas.run()
+    if args.profile:
+        Profile.start()
+
+    try:
+        if args.daemon:
+            stop = threading.Event()
+
+            def shutdown(signum, frame):
+                logger.info("Received signal %d, stopping", signum)
+                stop.set()
+
+            signal.signal(signal.SIGTERM, shutdown)
+            signal.signal(signal.SIGINT, shutdown)
+
+            idbiaas = IDBIaas(None, args.shard)
+            idbiaas.run_daemon(load_config, args.interval, args.reload_interval, stop)
+        elif args.processes > 1:
+            idbiaas = IDBIaas(load_config(), args.shard)
+            idbiaas.run_processes(args.processes)
+        elif args.export_snapshot:
+            idbiaas = IDBIaas(load_config(), args.shard)
+            idbiaas.export(args.export_snapshot)
+        else:
+            idbiaas = IDBIaas(load_config(), args.shard, args.import_snapshot)
+            idbiaas.run()
+    finally:
+        if args.profile:
+            Profile.stop(args.profile)
+
+    IDBSessions.close()
+    DriverCache.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,516 @@
+#! /usr/bin/env python
+"""Benchmarks for idbiaas, run from this directory: python idbiaas_bench.py {machines,run,startup} --help
+
+All benchmarks run offline: the IDB and the DigitalOcean API are served by an
+in-process fake server, libvirt hosts are fake libvirt connections.
+"""
+
+import argparse
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+import requests
+import libcloud.compute.drivers.libvirt_driver
+
+import idbiaas
+
+
+class LegacyMachine(object):
+    """IDBMachine as it was before using __slots__."""
+
+    def __init__(self, fqdn, vmhost, cpu, ram):
+        self.fqdn = fqdn
+        self.vmhost = vmhost
+        self.device_type_id = 2
+        self.cpu = cpu
+        self.ram = ram
+
+    def dict(self):
+        return {"fqdn": self.fqdn, "vmhost": self.vmhost,
+                "device_type_id": self.device_type_id,
+                "cores": self.cpu, "ram": self.ram}
+
+    def dict_v3(self):
+        return {"fqdn": self.fqdn, "vmhost": self.vmhost,
+                "cores": self.cpu, "ram": self.ram}
+
+
+def timed(func, *args):
+    """Return the result of func and the seconds it took."""
+    gc.collect()
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def record_size(machine):
+    """Return the bytes used by a machine record, including its attribute dict."""
+    size = sys.getsizeof(machine)
+    if hasattr(machine, "__dict__"):
+        size += sys.getsizeof(machine.__dict__)
+    return size
+
+
+def bench_machines(count=100000, chunksize=100):
+    """Compare creating and serializing count machines with the legacy and the current machine record."""
+    results = {"machines": count, "chunksize": chunksize}
+    idb = idbiaas.IDBv2("http://idb.example.org/api/v2", "token", chunksize=chunksize)
+
+    def create(cls):
+        return [cls("vm%d.example.org" % i, "host%d.example.org" % (i % 100), 2, 4096) for i in range(count)]
+
+    def serialize_legacy(machines):
+        size = 0
+        for i in range(0, len(machines), chunksize):
+            size += len(json.dumps({"create_machine": False,
+                                    "machines": [m.dict() for m in machines[i:i + chunksize]]}))
+        return size
+
+    def serialize(machines):
+        size = 0
+        for i in range(0, len(machines), chunksize):
+            size += len(idb.json_machines(machines[i:i + chunksize]))
+        return size
+
+    def serialize_v3_legacy(machines):
+        return sum(len(json.dumps(m.dict_v3())) for m in machines)
+
+    def serialize_v3(machines):
+        return sum(len(m.json(v3=True)) for m in machines)
+
+    for name, cls, serializer, serializer_v3 in (
+            ("legacy", LegacyMachine, serialize_legacy, serialize_v3_legacy),
+            ("current", idbiaas.IDBMachine, serialize, serialize_v3)):
+        machines, create_time = timed(create, cls)
+        size, serialize_time = timed(serializer, machines)
+        size_v3, serialize_v3_time = timed(serializer_v3, machines)
+
+        results[name] = {
+            "create_us_per_machine": create_time / count * 1e6,
+            "serialize_v2_us_per_machine": serialize_time / count * 1e6,
+            "serialize_v3_us_per_machine": serialize_v3_time / count * 1e6,
+            "bytes_per_record": record_size(machines[0]),
+            "json_v2_bytes": size,
+            "json_v3_bytes": size_v3,
+        }
+        del machines
+
+    results["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+class FakeServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the IDB API v2 and v3 below /api/v2 and /api/v3 and the DigitalOcean droplet list below /do/v2."""
+
+    protocol_version = "HTTP/1.1"
+    # buffer responses, unbuffered writes of every header line are delayed by Nagle and delayed acks
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None, headers=None):
+        data = json.dumps(body) if body is not None else ""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def body(self):
+        length = int(self.headers.getheader("Content-Length", 0))
+        self.server.bytes_received += length
+        return json.loads(self.rfile.read(length) or "null")
+
+    def handle_one_request(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+
+    def count(self):
+        with self.server.lock:
+            self.server.requests[self.command] = self.server.requests.get(self.command, 0) + 1
+
+    def do_GET(self):
+        self.count()
+        path, _, query = self.path.partition("?")
+        query = urlparse.parse_qs(query)
+
+        if path == "/do/v2/droplets":
+            page, per_page = int(query["page"][0]), int(query["per_page"][0])
+            droplets = [{"name": "droplet%d.example.org" % i, "vcpus": 1, "memory": 1024}
+                        for i in range((page - 1) * per_page, min(page * per_page, self.server.droplets))]
+            self.reply(200, {"droplets": droplets, "meta": {"total": self.server.droplets}})
+        elif path == "/api/v3/machines":
+            page, per_page = int(query["page"][0]), int(query["per_page"][0])
+            fqdns = sorted(self.server.machines)[(page - 1) * per_page:page * per_page]
+            self.reply(200, [self.server.machines[f] for f in fqdns])
+        elif path.startswith("/api/v3/machines/"):
+            fqdn = path[len("/api/v3/machines/"):]
+            if fqdn in self.server.machines:
+                self.reply(200, self.server.machines[fqdn])
+            else:
+                self.reply(404, {})
+        else:
+            self.reply(404, {})
+
+    def do_POST(self):
+        self.count()
+        machine = self.body()
+        self.server.machines[machine["fqdn"]] = machine
+        self.reply(201, machine)
+
+    def do_PUT(self):
+        self.count()
+        body = self.body()
+        if self.path == "/api/v2/machines":
+            for machine in body["machines"]:
+                self.server.machines[machine["fqdn"]] = machine
+        else:
+            self.server.machines[self.path[len("/api/v3/machines/"):]] = body
+        self.reply(200, body)
+
+
+class FakeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """In-process fake IDB and DigitalOcean API with a fixed latency per request."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, latency=0, droplets=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), FakeServerHandler)
+        self.latency = latency
+        self.droplets = droplets
+        self.machines = {}
+        self.requests = {}
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeDomain(object):
+    def __init__(self, name, latency):
+        self._name = name
+        self.latency = latency
+
+    def info(self):
+        time.sleep(self.latency)
+        return [1, 4194304, 2097152, 2, 0]
+
+    def name(self):
+        return self._name
+
+    def ID(self):
+        return 1
+
+    def UUIDString(self):
+        return "uuid-" + self._name
+
+    def OSType(self):
+        time.sleep(self.latency)
+        return "hvm"
+
+    def XMLDesc(self):
+        time.sleep(self.latency)
+        return "<domain/>"
+
+
+class FakeLibvirtConnection(object):
+    """libvirt connection to a host with a number of domains, each call sleeping latency seconds."""
+
+    def __init__(self, hostname, nodes, latency):
+        self.hostname = hostname
+        self.nodes = nodes
+        self.latency = latency
+
+    def isAlive(self):
+        return 1
+
+    def close(self):
+        pass
+
+    def listAllDomains(self):
+        time.sleep(self.latency)
+        return [FakeDomain("vm%d.%s" % (i, self.hostname), self.latency) for i in range(self.nodes)]
+
+    def getType(self):
+        time.sleep(self.latency)
+        return "QEMU"
+
+    def getHostname(self):
+        time.sleep(self.latency)
+        return self.hostname
+
+    def getAllDomainStats(self, stats):
+        time.sleep(self.latency)
+        return [(FakeDomain("vm%d.%s" % (i, self.hostname), self.latency),
+                 {"state.state": 1, "vcpu.current": 2, "balloon.current": 2097152,
+                  "block.count": 1, "block.0.name": "vda", "block.0.capacity": 21474836480,
+                  "net.count": 1, "net.0.name": "vnet%d" % i})
+                for i in range(self.nodes)]
+
+
+def fake_libvirt_connect(nodes, latency):
+    """Return a replacement for LibvirtZone.connect connecting to fake hosts with nodes domains each."""
+    def connect(zone, host):
+        driver = libcloud.compute.drivers.libvirt_driver.LibvirtNodeDriver.__new__(
+            libcloud.compute.drivers.libvirt_driver.LibvirtNodeDriver)
+        driver._uri = host.uri()
+        time.sleep(latency)
+        driver.connection = idbiaas.LibvirtRPCCounter(FakeLibvirtConnection(host.name, nodes, latency), host.uri())
+        return driver
+
+    return connect
+
+
+def fake_libvirt_connect_native(nodes, latency):
+    """Return a replacement for LibvirtZone.connect_native connecting to fake hosts with nodes domains each."""
+    def connect_native(zone, host):
+        time.sleep(latency)
+        return idbiaas.LibvirtCollector(
+            idbiaas.LibvirtRPCCounter(FakeLibvirtConnection(host.name, nodes, latency), host.uri()))
+
+    return connect_native
+
+
+class StageTimer(object):
+    """Accumulates the time spent in zone crawls and in IDB requests by method."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        with self.lock:
+            total, count = self.stages.get(stage, (0.0, 0))
+            self.stages[stage] = (total + seconds, count + 1)
+
+    def timed_machines(self, machines):
+        """Wrap a Zone.machines method, adding the time spent producing machines to the "crawl" stage."""
+        timer = self
+
+        def wrapper(zone):
+            it = iter(machines(zone))
+            while True:
+                start = time.time()
+                try:
+                    machine = next(it)
+                except StopIteration:
+                    timer.add("crawl", time.time() - start)
+                    return
+                timer.add("crawl", time.time() - start)
+                yield machine
+
+        return wrapper
+
+    def timed_send(self, send):
+        """Wrap requests.Session.send, adding the request time to a stage named after the method."""
+        timer = self
+
+        def wrapper(session, request, **kwargs):
+            start = time.time()
+            try:
+                return send(session, request, **kwargs)
+            finally:
+                timer.add(request.method, time.time() - start)
+
+        return wrapper
+
+    def report(self):
+        return dict((stage, {"seconds": total, "count": count})
+                    for stage, (total, count) in self.stages.items())
+
+
+def bench_run(hosts=10, nodes=50, droplets=0, api=3, latency=0.002, libvirt_latency=0.0005, idb_config=None,
+              metrics=False, collector="libcloud"):
+    """Run IDBIaas.run against fake hosts, a fake DigitalOcean account and a fake IDB.
+
+    With metrics the run is instrumented by idbiaas.Metrics and the report is included.
+    collector selects how the libvirt zone lists domains, "libcloud" or "native"."""
+    server = FakeServer(latency, droplets)
+    timer = StageTimer()
+
+    idb = dict({"url": server.url + "/api/v%d" % api, "version": api, "token": "token", "create": True},
+               **(idb_config or {}))
+    zones = []
+    libvirt_hosts = [{"name": "host%d.example.org" % i, "user": "bench"} for i in range(hosts)]
+    if hosts:
+        zones.append({"idb": idb, "driver": {"name": "libvirt", "hosts": libvirt_hosts, "collector": collector}})
+    if droplets:
+        zones.append({"idb": idb, "driver": {"name": "digitalocean", "token": "token", "version": "v2"}})
+
+    patched = [(idbiaas.LibvirtZone, "connect", fake_libvirt_connect(nodes, libvirt_latency)),
+               (idbiaas.LibvirtZone, "connect_native", fake_libvirt_connect_native(nodes, libvirt_latency)),
+               (idbiaas.DigitalOceanZone, "api_url", server.url + "/do/v2"),
+               (idbiaas.PartitionedZone, "machines", timer.timed_machines(idbiaas.PartitionedZone.machines.im_func)),
+               (idbiaas.DigitalOceanZone, "machines", timer.timed_machines(idbiaas.DigitalOceanZone.machines.im_func)),
+               (requests.Session, "send", timer.timed_send(requests.Session.send.im_func))]
+    originals = [(cls, name, cls.__dict__[name]) for cls, name, _ in patched]
+
+    uris = [idbiaas.LibvirtVMHost.from_dict(host).uri() for host in libvirt_hosts]
+    calls = sum(idbiaas.LibvirtRPCCounter.calls(uri) for uri in uris)
+
+    idbiaas.Metrics.reset()
+    idbiaas.Metrics.enabled = metrics
+
+    try:
+        for cls, name, value in patched:
+            setattr(cls, name, value)
+
+        _, elapsed = timed(idbiaas.IDBIaas({"zones": zones}).run)
+    finally:
+        for cls, name, value in originals:
+            setattr(cls, name, value)
+        idbiaas.Metrics.enabled = False
+        idbiaas.IDBSessions.close()
+        idbiaas.DriverCache.close()
+        server.stop()
+
+    results = {
+        "machines": hosts * nodes + droplets,
+        "submitted": len(server.machines),
+        "seconds": elapsed,
+        "requests": server.requests,
+        "bytes_sent": server.bytes_received,
+        "libvirt_calls": sum(idbiaas.LibvirtRPCCounter.calls(uri) for uri in uris) - calls,
+        "stages": timer.report(),
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+    if metrics:
+        results["metrics"] = idbiaas.Metrics.report()["metrics"]
+
+    return results
+
+
+# run in a fresh interpreter by bench_startup, prints the import times as json
+STARTUP_SCRIPT = r"""
+import sys, time, json, __builtin__
+
+started = time.time()
+imports = {}
+nested = []
+original_import = __builtin__.__import__
+
+
+def timed_import(name, *args, **kwargs):
+    # like python3 -X importtime: time spent in each import statement, with and without nested imports
+    nested.append(0.0)
+    start = time.time()
+    try:
+        return original_import(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        inner = nested.pop()
+        if nested:
+            nested[-1] += elapsed
+        total, own = imports.get(name, (0.0, 0.0))
+        imports[name] = (total + elapsed, own + elapsed - inner)
+
+__builtin__.__import__ = timed_import
+
+if "--eager" in sys.argv:
+    # the imports of idbiaas before libcloud was imported lazily
+    import libcloud.compute.types
+    import libcloud.compute.providers
+
+import idbiaas
+imported = time.time()
+
+idbiaas.IDBIaas(json.loads(sys.argv[1])).run()
+finished = time.time()
+
+__builtin__.__import__ = original_import
+print(json.dumps({
+    "import_seconds": imported - started,
+    "run_seconds": finished - imported,
+    "modules": len([m for m in sys.modules.values() if m is not None]),
+    "libcloud_imported": "libcloud" in sys.modules,
+    "imports": sorted(([n, t, o] for n, (t, o) in imports.items() if t > 0.001), key=lambda x: -x[1])[:15],
+}))
+"""
+
+
+def bench_startup(runs=10, eager=False):
+    """Time cold starts of a short run in fresh interpreters: a libvirt zone without hosts, nothing to submit.
+
+    With eager the libcloud modules are imported up front like before they were imported lazily."""
+    config = json.dumps({"zones": [{
+        "idb": {"url": "http://127.0.0.1:9/api/v3", "version": 3, "token": "token"},
+        "driver": {"name": "libvirt", "hosts": []}}]})
+    command = [sys.executable, "-c", STARTUP_SCRIPT, config] + (["--eager"] if eager else [])
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    samples = []
+    for _ in range(runs):
+        start = time.time()
+        output = subprocess.check_output(command, cwd=cwd)
+        samples.append((time.time() - start, json.loads(output)))
+
+    samples.sort(key=lambda x: x[0])
+    wall, median = samples[len(samples) // 2]
+    return dict(median, process_seconds=wall, runs=runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run idbiaas benchmarks.')
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    machines_parser = subparsers.add_parser("machines", help="machine record and serialization microbenchmark")
+    machines_parser.add_argument("count", type=int, nargs="?", default=100000)
+    machines_parser.add_argument("--chunksize", type=int, default=100)
+
+    run_parser = subparsers.add_parser("run", help="end-to-end IDBIaas.run against fake hosts and a fake IDB")
+    run_parser.add_argument("--hosts", type=int, default=10, help="number of libvirt hosts")
+    run_parser.add_argument("--nodes", type=int, default=50, help="number of vms per libvirt host")
+    run_parser.add_argument("--droplets", type=int, default=0, help="number of DigitalOcean droplets")
+    run_parser.add_argument("--api", type=int, choices=(2, 3), default=3, help="IDB API version")
+    run_parser.add_argument("--latency", type=float, default=0.002, help="seconds per IDB or DigitalOcean request")
+    run_parser.add_argument("--libvirt-latency", type=float, default=0.0005, help="seconds per libvirt call")
+    run_parser.add_argument("--idb-config", type=json.loads, default={},
+                            help="JSON object merged into the zone idb config, e.g. '{\"engine\": \"concurrent\"}'")
+    run_parser.add_argument("--metrics", action="store_true", help="enable idbiaas.Metrics and include its report")
+    run_parser.add_argument("--collector", choices=("libcloud", "native"), default="libcloud",
+                            help="how libvirt domains are listed")
+
+    startup_parser = subparsers.add_parser("startup", help="cold start of a short run in a fresh interpreter")
+    startup_parser.add_argument("--runs", type=int, default=10, help="number of interpreters started, the median is reported")
+    startup_parser.add_argument("--eager", action="store_true", help="import libcloud up front for comparison")
+
+    args = parser.parse_args()
+
+    if args.benchmark == "machines":
+        results = bench_machines(args.count, args.chunksize)
+    elif args.benchmark == "run":
+        results = bench_run(args.hosts, args.nodes, args.droplets, args.api, args.latency,
+                            args.libvirt_latency, args.idb_config, args.metrics,
+                            args.collector)
+    elif args.benchmark == "startup":
+        results = bench_startup(args.runs, args.eager)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
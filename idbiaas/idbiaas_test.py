@@ -1,5 +1,22 @@
 import unittest
+import time
+import shutil
+import tempfile
+import json
+import threading
+import BaseHTTPServer
+import SocketServer
+import urlparse
+import subprocess
+import sys
+import email.utils
+import gzip
+import os
+import pstats
+import requests
+import libcloud.compute.base
 import libcloud.compute.types
+import libcloud.compute.drivers.libvirt_driver
 
 import idbiaas
 
@@ -45,6 +62,8 @@ class ZoneTest(unittest.TestCase):
         self.assertIsInstance(x, idbiaas.DigitalOceanZone)
         self.assertEqual(x.token, "testtoken")
         self.assertEqual(x.version, "v2")
+        self.assertEqual(len(x.key), 12)
+        self.assertNotEqual(x.key, idbiaas.Zone.from_dict(libvirt_zone_config).key)
 
     def test_from_dict_libvirt(self):
         x = idbiaas.Zone.from_dict(libvirt_zone_config)
@@ -55,6 +74,61 @@ class ZoneTest(unittest.TestCase):
         self.assertEqual(x.hosts[1].name, "host1.example.org")
         self.assertEqual(x.hosts[1].user, "testuser")
 
+    def test_zones_from_dict(self):
+        other = dict(libvirt_zone_config, idb=dict(libvirt_zone_config["idb"], url="http://other.example.org"))
+        zones = idbiaas.IDBIaas.zones_from_dict({"zones": [libvirt_zone_config, other]})
+        # one crawl may feed several IDBs
+        self.assertEqual(zones[0].key, zones[1].key)
+
+        self.assertRaises(idbiaas.InvalidZoneConfigError, idbiaas.IDBIaas.zones_from_dict,
+                          {"zones": [libvirt_zone_config, libvirt_zone_config]})
+
+
+class CustomZone(object):
+    @classmethod
+    def from_dict(cls, dict_config):
+        zone = CustomZone()
+        zone.size = dict_config["size"]
+        return zone
+
+
+class ZoneRegistryTest(unittest.TestCase):
+    def tearDown(self):
+        idbiaas.Zone.drivers.pop("custom", None)
+        idbiaas.DriverCache.close()
+
+    def test_register(self):
+        config = dict(do_zone_config, driver={"name": "custom", "size": 3})
+        self.assertRaises(idbiaas.UnknownDriverError, idbiaas.Zone.from_dict, config)
+
+        idbiaas.Zone.register("custom", CustomZone)
+        x = idbiaas.Zone.from_dict(config)
+        self.assertIsInstance(x, CustomZone)
+        self.assertEqual(x.size, 3)
+        self.assertEqual(len(x.key), 12)
+
+    def test_libcloud(self):
+        config = dict(do_zone_config, driver={"name": "libcloud", "provider": "dummy", "options": {"creds": 0},
+                                              "regions": [{}, {"creds": 3}], "ram": "foo"})
+        x = idbiaas.Zone.from_dict(config)
+        self.assertIsInstance(x, idbiaas.LibcloudZone)
+
+        machines = list(x.machines())
+        self.assertEqual([m.fqdn for m in machines], ["dummy-1", "dummy-2", "dummy-0", "dummy-1", "dummy-2"])
+        self.assertEqual((machines[0].cpu, machines[0].ram), (None, "bar"))
+        # the unknown cores don't overwrite the IDB
+        self.assertEqual(json.loads(machines[0].json(v3=True)), {"fqdn": "dummy-1", "vmhost": "", "ram": "bar"})
+
+    def test_libcloud_size(self):
+        zone = idbiaas.LibcloudZone("dummy", [0], {})
+        size = libcloud.compute.base.NodeSize("m1", "m1", 2048, 20, None, None, None, extra={"cpu": 2})
+        node = libcloud.compute.base.Node("i-1", "vm0", 0, [], [], None, size=size, extra={})
+        machine = zone.node_machine(node)
+        self.assertEqual((machine.cpu, machine.ram), (2, 2048))
+
+        node = libcloud.compute.base.Node("i-2", "vm1", 0, [], [], None, extra={})
+        self.assertEqual(json.loads(zone.node_machine(node).json()), {"fqdn": "vm1", "vmhost": "", "device_type_id": 2})
+
 
 class LibvirtZoneTest(unittest.TestCase):
     def test_from_dict(self):
@@ -71,6 +145,1634 @@ class LibvirtZoneTest(unittest.TestCase):
         self.assertIsInstance(x, list)
         self.assertEqual(len(x), 2)
 
+    def test_from_dict_concurrency(self):
+        x = idbiaas.LibvirtZone.from_dict(libvirt_zone_config["driver"])
+        self.assertEqual(x.concurrency, 8)
+        self.assertEqual(x.timeout, None)
+
+        config = dict(libvirt_zone_config["driver"], concurrency=2, timeout=30)
+        x = idbiaas.LibvirtZone.from_dict(config)
+        self.assertEqual(x.concurrency, 2)
+        self.assertEqual(x.timeout, 30)
+
+    def test_machines_keeps_host_order(self):
+        x = idbiaas.LibvirtZone.from_dict(libvirt_zone_config["driver"])
+
+        def host_machines(host):
+            # let the first host finish last
+            if host.name == "host0.example.org":
+                time.sleep(0.1)
+            return [idbiaas.IDBMachine("vm." + host.name, host.name, 1, 1024)]
+
+        x.host_machines = host_machines
+        self.assertEqual([m.fqdn for m in x.machines()],
+                         ["vm.host0.example.org", "vm.host1.example.org"])
+
+
+class FakeLibvirtConnection(object):
+    def __init__(self):
+        self.alive = 1
+        self.closed = False
+
+    def isAlive(self):
+        return self.alive
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDriver(object):
+    def __init__(self):
+        self.connection = FakeLibvirtConnection()
+
+
+class DriverCacheTest(unittest.TestCase):
+    def tearDown(self):
+        idbiaas.DriverCache.close()
+        idbiaas.DriverCache.max_idle = 600
+        idbiaas.DriverCache.connect_wait = 60
+
+    def test_reuse(self):
+        a = idbiaas.DriverCache.get("libvirt", "qemu+ssh://a/system", None, FakeDriver)
+        self.assertIs(idbiaas.DriverCache.get("libvirt", "qemu+ssh://a/system", None, FakeDriver), a)
+        self.assertIsNot(idbiaas.DriverCache.get("libvirt", "qemu+ssh://b/system", None, FakeDriver), a)
+        self.assertIsNot(idbiaas.DriverCache.get("digitalocean", "qemu+ssh://a/system", "v2", FakeDriver), a)
+
+    def test_dead(self):
+        a = idbiaas.DriverCache.get("libvirt", "qemu+ssh://a/system", None, FakeDriver)
+        a.connection.alive = 0
+        b = idbiaas.DriverCache.get("libvirt", "qemu+ssh://a/system", None, FakeDriver)
+        self.assertIsNot(a, b)
+        self.assertTrue(a.connection.closed)
+
+    def test_evict_idle(self):
+        a = idbiaas.DriverCache.get("libvirt", "qemu+ssh://a/system", None, FakeDriver)
+        idbiaas.DriverCache.evict_idle()
+        self.assertFalse(a.connection.closed)
+
+        idbiaas.DriverCache.max_idle = -1
+        idbiaas.DriverCache.evict_idle()
+        self.assertTrue(a.connection.closed)
+        self.assertIsNot(idbiaas.DriverCache.get("libvirt", "qemu+ssh://a/system", None, FakeDriver), a)
+
+    def test_close(self):
+        a = idbiaas.DriverCache.get("libvirt", "qemu+ssh://a/system", None, FakeDriver)
+        idbiaas.DriverCache.close()
+        self.assertTrue(a.connection.closed)
+
+    def test_hung_connect(self):
+        idbiaas.DriverCache.connect_wait = 0.05
+        connected = threading.Event()
+
+        def hang():
+            connected.wait(1)
+            return FakeDriver()
+
+        t = threading.Thread(target=idbiaas.DriverCache.get, args=("libvirt", "qemu+ssh://a/system", None, hang))
+        t.daemon = True
+        t.start()
+        time.sleep(0.02)
+
+        # other threads give up on the host instead of blocking behind the hung connect
+        self.assertRaises(idbiaas.ConnectPendingError, idbiaas.DriverCache.get,
+                          "libvirt", "qemu+ssh://a/system", None, FakeDriver)
+        connected.set()
+        t.join()
+        self.assertIsNotNone(idbiaas.DriverCache.get("libvirt", "qemu+ssh://a/system", None, FakeDriver))
+
+
+class FakeDomain(object):
+    def __init__(self, name):
+        self._name = name
+
+    def info(self):
+        return [1, 2097152, 1048576, 2, 0]
+
+    def name(self):
+        return self._name
+
+    def ID(self):
+        return 1
+
+    def UUIDString(self):
+        return "uuid-" + self._name
+
+    def OSType(self):
+        return "hvm"
+
+    def XMLDesc(self):
+        return "<domain/>"
+
+
+class FakeLibvirt(FakeLibvirtConnection):
+    def __init__(self, domains):
+        FakeLibvirtConnection.__init__(self)
+        self.domains = domains
+
+    def listAllDomains(self):
+        return [FakeDomain(name) for name in self.domains]
+
+    def getType(self):
+        return "QEMU"
+
+    def getHostname(self):
+        return "host0.example.org"
+
+    def getAllDomainStats(self, stats):
+        return [(FakeDomain(name), {"vcpu.current": 2, "balloon.current": 1048576,
+                                    "block.count": 2, "block.0.capacity": 1024, "block.1.capacity": 2048,
+                                    "net.count": 1, "net.0.name": "vnet" + name})
+                for name in self.domains]
+
+
+class LibvirtRPCTest(unittest.TestCase):
+    def setUp(self):
+        self.zone = idbiaas.LibvirtZone.from_dict(libvirt_zone_config["driver"])
+
+        def connect(host):
+            driver = libcloud.compute.drivers.libvirt_driver.LibvirtNodeDriver.__new__(
+                libcloud.compute.drivers.libvirt_driver.LibvirtNodeDriver)
+            driver._uri = host.uri()
+            driver.connection = idbiaas.LibvirtRPCCounter(FakeLibvirt(["vm0", "vm1", "vm2"]), host.uri())
+            return driver
+
+        self.zone.connect = connect
+
+    def tearDown(self):
+        idbiaas.DriverCache.close()
+
+    def test_machines(self):
+        machines = list(self.zone.machines())
+        self.assertEqual([(m.fqdn, m.vmhost, m.cpu, m.ram) for m in machines[:3]],
+                         [("vm0", "host0.example.org", 2, 1024), ("vm1", "host0.example.org", 2, 1024),
+                          ("vm2", "host0.example.org", 2, 1024)])
+
+    def test_rpc_count(self):
+        uri = self.zone.hosts[0].uri()
+        calls = idbiaas.LibvirtRPCCounter.calls(uri)
+        self.zone.host_machines(self.zone.hosts[0])
+        # listAllDomains, info, OSType and getType for each domain, getHostname once
+        self.assertEqual(idbiaas.LibvirtRPCCounter.calls(uri) - calls, 1 + 3 * 3 + 1)
+
+        # host facts are kept with the cached connection
+        calls = idbiaas.LibvirtRPCCounter.calls(uri)
+        self.zone.host_machines(self.zone.hosts[0])
+        self.assertEqual(idbiaas.LibvirtRPCCounter.calls(uri) - calls, 1 + 3 * 3)
+
+
+class LibvirtCollectorTest(unittest.TestCase):
+    def setUp(self):
+        self.zone = idbiaas.LibvirtZone.from_dict(dict(libvirt_zone_config["driver"], collector="native"))
+        self.connection = FakeLibvirt(["vm0", "vm1", "vm2"])
+        self.zone.connect_native = lambda host: idbiaas.LibvirtCollector(
+            idbiaas.LibvirtRPCCounter(self.connection, host.uri()))
+
+    def tearDown(self):
+        idbiaas.DriverCache.close()
+
+    def test_from_dict(self):
+        self.assertEqual(self.zone.collector, "native")
+        self.assertFalse(self.zone.details)
+        self.assertEqual(idbiaas.LibvirtZone.from_dict(libvirt_zone_config["driver"]).collector, "libcloud")
+        self.assertRaises(idbiaas.InvalidZoneConfigError, idbiaas.LibvirtZone.from_dict,
+                          dict(libvirt_zone_config["driver"], collector="foo"))
+
+    def test_machines(self):
+        machines = self.zone.host_machines(self.zone.hosts[0])
+        self.assertEqual([(m.fqdn, m.vmhost, m.cpu, m.ram, m.extra()) for m in machines],
+                         [("vm0", "host0.example.org", 2, 1024, {}), ("vm1", "host0.example.org", 2, 1024, {}),
+                          ("vm2", "host0.example.org", 2, 1024, {})])
+
+    def test_details(self):
+        self.zone.details = True
+        machine = self.zone.host_machines(self.zone.hosts[0])[0]
+        self.assertEqual(machine.extra(), {"diskspace": 3072, "nics": [{"name": "vnetvm0"}]})
+
+    def test_info_fallback(self):
+        self.connection.getAllDomainStats = lambda stats: [(FakeDomain("vm0"), {"vcpu.current": 4})]
+        machine = self.zone.host_machines(self.zone.hosts[0])[0]
+        self.assertEqual((machine.cpu, machine.ram), (2, 1024))
+
+    def test_rpc_count(self):
+        uri = self.zone.hosts[0].uri()
+        calls = idbiaas.LibvirtRPCCounter.calls(uri)
+        self.zone.host_machines(self.zone.hosts[0])
+        # getAllDomainStats for all domains, getHostname once
+        self.assertEqual(idbiaas.LibvirtRPCCounter.calls(uri) - calls, 2)
+
+        calls = idbiaas.LibvirtRPCCounter.calls(uri)
+        self.zone.host_machines(self.zone.hosts[0])
+        self.assertEqual(idbiaas.LibvirtRPCCounter.calls(uri) - calls, 1)
+
+    def test_failed(self):
+        def fail(stats):
+            raise Exception("connection lost")
+
+        self.connection.getAllDomainStats = fail
+        self.assertIsNone(self.zone.host_machines(self.zone.hosts[0]))
+
+        # machines of the failed hosts are missing, so the zone is incomplete
+        self.assertEqual(list(self.zone.machines()), [])
+        self.assertFalse(self.zone.complete)
+
+
+class IDBMachineTest(unittest.TestCase):
+    def test_json(self):
+        x = idbiaas.IDBMachine(u"vm\xe4.example.org", "host0.example.org", 2, 1024)
+        self.assertEqual(json.loads(x.json()), x.dict())
+        self.assertEqual(json.loads(x.json(v3=True)), x.dict_v3())
+        self.assertFalse(hasattr(x, "__dict__"))
+
+    def test_json_extra(self):
+        x = idbiaas.IDBMachine("vm.example.org", "host0.example.org", 2, 1024)
+        x.diskspace = 3072
+        x.nics = [{"name": u"vnet\xe4"}]
+        self.assertEqual(json.loads(x.json()), x.dict())
+        self.assertEqual(json.loads(x.json(v3=True)), x.dict_v3())
+        self.assertEqual(x.dict_v3()["diskspace"], 3072)
+
+    def test_json_machines(self):
+        idb = idbiaas.IDBv2("http://example.org", "idbtoken", create=True)
+        machines = [idbiaas.IDBMachine("vm%d.example.org" % i, "", i, None) for i in range(3)]
+        self.assertEqual(json.loads(idb.json_machines(machines + [None])),
+                         {"create_machine": True, "machines": [m.dict() for m in machines]})
+        self.assertEqual(json.loads(idb.json_machines([])), {"create_machine": True, "machines": []})
+
+
+class MapBoundedTest(unittest.TestCase):
+    def test_order(self):
+        x = idbiaas.map_bounded(lambda i: i * 2, [3, 2, 1], concurrency=2)
+        self.assertEqual(x, [6, 4, 2])
+
+    def test_error(self):
+        def f(i):
+            if i == 1:
+                raise Exception("failed")
+            return i
+
+        x = idbiaas.map_bounded(f, [0, 1, 2], concurrency=3)
+        self.assertEqual(x, [0, None, 2])
+
+    def test_timeout(self):
+        def f(i):
+            time.sleep(i)
+            return i
+
+        start = time.time()
+        x = idbiaas.map_bounded(f, [0, 5, 0], concurrency=1, timeout=0.2)
+        self.assertEqual(x, [0, None, 0])
+        self.assertLess(time.time() - start, 2)
+
+
+class StubIDBHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # buffer responses, unbuffered writes of every header line are delayed by Nagle and delayed acks
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None, headers=None):
+        data = json.dumps(body) if body is not None else ""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def body(self):
+        return json.loads(self.rfile.read(int(self.headers.getheader("Content-Length", 0))) or "null")
+
+    def owner(self, fqdn):
+        return self.server.owners.get(fqdn, self.headers.getheader("X-IDB-API-Token"))
+
+    def handle_one_request(self):
+        time.sleep(self.server.latency)
+        BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+
+    def do_GET(self):
+        self.server.log.append(("GET", self.path))
+        path, _, query = self.path.partition("?")
+        if path.endswith("/machines"):
+            if not self.server.listing:
+                self.reply(404, {})
+                return
+            query = urlparse.parse_qs(query)
+            page, per_page = int(query["page"][0]), min(int(query["per_page"][0]), self.server.max_per_page)
+            token = self.headers.getheader("X-IDB-API-Token")
+            machines = [self.server.machines[f] for f in sorted(self.server.machines) if self.owner(f) == token]
+            self.reply(200, machines[(page - 1) * per_page:page * per_page])
+            return
+
+        fqdn = path.split("/machines/", 1)[-1]
+        if self.server.machines.has_key(fqdn):
+            self.reply(200, self.server.machines[fqdn], {"X-Idb-Api-Token": self.owner(fqdn)})
+        else:
+            self.reply(404, {})
+
+    def do_POST(self):
+        body = self.body()
+        self.server.log.append(("POST", self.path))
+        self.server.machines[body["fqdn"]] = body
+        self.reply(201, body)
+
+    def do_PUT(self):
+        body = self.body()
+        self.server.log.append(("PUT", self.path))
+        if self.path.endswith("/machines"):
+            if [m for m in body["machines"] if m["fqdn"] in self.server.reject]:
+                self.reply(422, {})
+                return
+            for machine in body["machines"]:
+                self.server.machines[machine["fqdn"]] = machine
+        else:
+            self.server.machines[self.path.split("/machines/", 1)[-1]] = body
+        self.reply(200, body)
+
+    def do_DELETE(self):
+        self.server.log.append(("DELETE", self.path))
+        if self.server.machines.pop(self.path.split("/machines/", 1)[-1], None) is None:
+            self.reply(404, {})
+        else:
+            self.reply(204)
+
+
+class StubDigitalOceanHandler(StubIDBHandler):
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        query = urlparse.parse_qs(query)
+        self.server.log.append(("GET", self.path))
+        page, per_page = int(query["page"][0]), int(query["per_page"][0])
+        droplets = [d for d in self.server.droplets if "tag_name" not in query or query["tag_name"][0] in d["tags"]]
+        self.reply(200, {"droplets": droplets[(page - 1) * per_page:page * per_page],
+                         "meta": {"total": len(droplets)}})
+        if page == 1 and getattr(self.server, "destroy_after_first_page", False):
+            del self.server.droplets[0]
+
+
+class FlakyIDBHandler(StubIDBHandler):
+    """Answers requests with the faults queued in server.faults before behaving like the stub IDB.
+
+    A fault is a tuple of status, headers and delay, a status of None only delays the request."""
+
+    def fault(self):
+        with self.server.lock:
+            fault = self.server.faults.pop(0) if self.server.faults else None
+
+        if fault is None:
+            return False
+
+        status, headers, delay = fault
+        time.sleep(delay)
+        if status is None:
+            return False
+
+        self.rfile.read(int(self.headers.getheader("Content-Length", 0)))
+        self.server.log.append((self.command, self.path, status))
+        self.reply(status, {}, headers)
+        return True
+
+    def do_GET(self):
+        if not self.fault():
+            StubIDBHandler.do_GET(self)
+
+    def do_POST(self):
+        if not self.fault():
+            StubIDBHandler.do_POST(self)
+
+    def do_PUT(self):
+        if not self.fault():
+            StubIDBHandler.do_PUT(self)
+
+
+class StubConfigHandler(StubIDBHandler):
+    """Serves server.providers as cloud providers of the API v2 and v3, with server.etag as ETag."""
+
+    def do_GET(self):
+        self.server.log.append(("GET", self.path))
+        if self.headers.getheader("If-None-Match") == self.server.etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        headers = {"ETag": self.server.etag}
+        if self.path.endswith("/cloud_providers"):
+            self.reply(200, self.server.providers, headers)
+            return
+
+        name = self.path.split("/cloud_providers/", 1)[-1]
+        providers = [p for p in self.server.providers if p["name"] == name]
+        if providers:
+            self.reply(200, providers[0], headers)
+        else:
+            self.reply(404, {})
+
+
+class StubIDB(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local IDB API server keeping machines in memory."""
+    daemon_threads = True
+
+    def __init__(self, handler=StubIDBHandler):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), handler)
+        self.machines = {}
+        self.owners = {}
+        self.latency = 0
+        self.listing = True
+        self.max_per_page = 1000
+        self.reject = set()
+        self.faults = []
+        self.providers = []
+        self.etag = '"1"'
+        self.lock = threading.Lock()
+        self.log = []
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class DigitalOceanZoneTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubIDB(StubDigitalOceanHandler)
+        self.server.droplets = [{"name": "droplet%d" % i, "vcpus": 1, "memory": 512,
+                                 "tags": ["web"] if i % 2 else []} for i in range(25)]
+        self.zone = idbiaas.Zone.from_dict(do_zone_config)
+        self.zone.api_url = self.server.url + "/v2"
+
+    def tearDown(self):
+        idbiaas.IDBSessions.close()
+        self.server.stop()
+
+    def test_from_dict(self):
+        config = dict(do_zone_config["driver"], per_page=50, concurrency=2, tag="web")
+        x = idbiaas.DigitalOceanZone.from_dict(config)
+        self.assertEqual((x.per_page, x.concurrency, x.tag), (50, 2, "web"))
+
+    def test_pages(self):
+        self.zone.per_page = 4
+        self.server.latency = 0.05
+        start = time.time()
+        machines = list(self.zone.machines())
+
+        self.assertEqual([m.fqdn for m in machines], ["droplet%d" % i for i in range(25)])
+        self.assertEqual((machines[0].cpu, machines[0].ram), (1, 512))
+        self.assertEqual(len(self.server.log), 7)
+        # the first page, then 6 pages with up to 4 at a time
+        self.assertLess(time.time() - start, 0.35)
+
+    def test_list_changed(self):
+        self.zone.per_page = 4
+        self.server.destroy_after_first_page = True
+
+        # droplet4 moved to the first page after it was fetched
+        machines = list(self.zone.machines())
+        self.assertNotIn("droplet4", [m.fqdn for m in machines])
+        self.assertFalse(self.zone.complete)
+
+    def test_timeout(self):
+        self.zone.timeout = (1, 0.1)
+        self.server.latency = 0.3
+        self.assertEqual(list(self.zone.machines()), [])
+        self.assertFalse(self.zone.complete)
+        # let the stub answer the abandoned request before it is stopped
+        time.sleep(0.3)
+
+    def test_tag(self):
+        self.zone.tag = "web"
+        self.assertEqual(len(list(self.zone.machines())), 12)
+        self.assertTrue("tag_name=web" in self.server.log[0][1])
+
+
+class IDBSessionsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubIDB()
+
+    def tearDown(self):
+        idbiaas.IDBSessions.close()
+        self.server.stop()
+
+    def test_shared(self):
+        a = idbiaas.IDBv3(self.server.url, "idbtoken")
+        b = idbiaas.IDBv3(self.server.url, "othertoken")
+        self.assertIs(a.session, b.session)
+        self.assertIsNot(a.session, idbiaas.IDBv3(self.server.url, "idbtoken", verify=False).session)
+
+    def test_keep_alive(self):
+        self.server.machines["vm0.example.org"] = {"fqdn": "vm0.example.org"}
+        idb = idbiaas.IDBv3(self.server.url, "idbtoken", create=True)
+        idb.submit_machines([idbiaas.IDBMachine("vm%d.example.org" % i, "", 1, 1024) for i in range(5)])
+
+        # two pages of the listing, a PUT for vm0 and a GET and POST for each new machine
+        self.assertEqual(len(self.server.log), 11)
+        self.assertEqual(idbiaas.IDBSessions.stats(idb.session), (1, 11))
+
+    def test_grow_pool(self):
+        session = idbiaas.IDBSessions.get(self.server.url)
+        adapter = session.get_adapter(self.server.url)
+        self.assertEqual(adapter._pool_maxsize, 10)
+
+        # the session in use isn't changed, a new one with the larger pool replaces it
+        idb = idbiaas.IDBv3(self.server.url, "idbtoken", pool_size=64)
+        self.assertIsNot(idb.session, session)
+        self.assertIs(session.get_adapter(self.server.url), adapter)
+        self.assertEqual(idb.session.get_adapter(self.server.url)._pool_maxsize, 64)
+
+        # a smaller pool doesn't shrink it
+        self.assertIs(idbiaas.IDBSessions.get(self.server.url, pool_size=4), idb.session)
+
+
+class IDBv2Test(unittest.TestCase):
+    def setUp(self):
+        self.server = StubIDB()
+
+    def tearDown(self):
+        idbiaas.IDBSessions.close()
+        self.server.stop()
+
+    def machines(self, n):
+        return [idbiaas.IDBMachine("vm%d.example.org" % i, "", 1, 1024) for i in range(n)]
+
+    def test_from_dict(self):
+        x = idbiaas.IDBv2.from_dict({"url": self.server.url, "token": "idbtoken", "chunksize": 50,
+                                     "adaptive": True, "max_payload": 4096})
+        self.assertEqual(x.chunksize, 50)
+        self.assertTrue(x.adaptive)
+        self.assertEqual(x.max_payload, 4096)
+
+    def test_chunksize(self):
+        idb = idbiaas.IDBv2(self.server.url, "idbtoken", chunksize=4)
+        idb.submit_machines(self.machines(10))
+        self.assertEqual(len(self.server.log), 3)
+        self.assertEqual(len(self.server.machines), 10)
+
+    def test_split_rejected(self):
+        self.server.reject.add("vm5.example.org")
+        idb = idbiaas.IDBv2(self.server.url, "idbtoken", chunksize=8)
+        idb.submit_machines(self.machines(8))
+        self.assertEqual(sorted(self.server.machines.keys()),
+                         ["vm%d.example.org" % i for i in range(8) if i != 5])
+
+    def test_no_split_unauthorized(self):
+        server = StubIDB(FlakyIDBHandler)
+        server.faults = [(403, {}, 0), (401, {}, 0)]
+        try:
+            idb = idbiaas.IDBv2(server.url, "wrongtoken", chunksize=8)
+            idb.submit_machines(self.machines(16))
+        finally:
+            server.stop()
+
+        # every chunk is given up after one PUT
+        self.assertEqual([x for x in server.log if x[0] == "PUT"],
+                         [("PUT", "/machines", 403), ("PUT", "/machines", 401)])
+        self.assertEqual(server.machines, {})
+
+    def test_split_payload(self):
+        idb = idbiaas.IDBv2(self.server.url, "idbtoken", chunksize=8)
+        idb.max_payload = len(idb.json_machines(self.machines(2)))
+        idb.submit_machines(self.machines(8))
+        self.assertEqual(len([x for x in self.server.log if x[0] == "PUT"]), 4)
+        self.assertEqual(len(self.server.machines), 8)
+
+    def test_tune_chunksize(self):
+        idb = idbiaas.IDBv2(self.server.url, "idbtoken", adaptive=True)
+        idb.max_payload = 1000
+        self.assertEqual(idb.tune_chunksize(10, 0.1, 100), 20)
+        self.assertEqual(idb.tune_chunksize(10, 1.5, 100), 10)
+        self.assertEqual(idb.tune_chunksize(10, 3, 100), 5)
+        self.assertEqual(idb.tune_chunksize(10, 0.1, 800), 12)
+        self.assertEqual(idb.tune_chunksize(1, 3, 100), 1)
+
+
+class IDBv3Test(unittest.TestCase):
+    def setUp(self):
+        self.server = StubIDB()
+        for i in range(5):
+            fqdn = "vm%d.example.org" % i
+            self.server.machines[fqdn] = {"fqdn": fqdn}
+            self.server.owners[fqdn] = "token%d" % (i % 2)
+
+    def tearDown(self):
+        idbiaas.IDBSessions.close()
+        self.server.stop()
+
+    def machines(self, n):
+        return [idbiaas.IDBMachine("vm%d.example.org" % i, "", 2, 2048) for i in range(n)]
+
+    def test_machine_index(self):
+        idb = idbiaas.IDBv3(self.server.url, ["token0", "token1"])
+        idb.page_size = 2
+        self.assertEqual(idb.machine_index(), {"vm0.example.org": "token0", "vm1.example.org": "token1",
+                                               "vm2.example.org": "token0", "vm3.example.org": "token1",
+                                               "vm4.example.org": "token0"})
+
+    def test_capped_pages(self):
+        for i in range(5, 120):
+            fqdn = "vm%d.example.org" % i
+            self.server.machines[fqdn] = {"fqdn": fqdn}
+            self.server.owners[fqdn] = "token0"
+        self.server.max_per_page = 50
+
+        idb = idbiaas.IDBv3(self.server.url, "token0")
+        self.assertEqual(len(idb.machine_index()), 118)
+        idb.submit_machines(self.machines(120))
+        # vm1 and vm3 of token1 aren't listed and are found with a GET
+        self.assertEqual(len([x for x in self.server.log if x[0] == "PUT"]), 120)
+        self.assertEqual(self.server.machines["vm119.example.org"]["cores"], 2)
+
+    def test_missing_from_index(self):
+        idb = idbiaas.IDBv3(self.server.url, "token0")
+        index = idb.machine_index()
+        self.server.machines["vm5.example.org"] = {"fqdn": "vm5.example.org"}
+
+        # machines created since the listing are updated, not created again
+        idb.submit_machine(self.machines(6)[5], index)
+        self.assertEqual(self.server.machines["vm5.example.org"]["cores"], 2)
+
+    def test_submit_prefetch(self):
+        idb = idbiaas.IDBv3(self.server.url, ["token0", "token1"], create=True)
+        idb.submit_machines(self.machines(6))
+
+        # vm5 isn't listed and is checked once more before it is skipped
+        self.assertEqual([x[0] for x in self.server.log], ["GET"] * 4 + ["PUT"] * 5 + ["GET"])
+        self.assertEqual(self.server.machines["vm3.example.org"]["cores"], 2)
+        self.assertFalse(self.server.machines.has_key("vm5.example.org"))
+
+    def test_submit_fallback(self):
+        self.server.listing = False
+        idb = idbiaas.IDBv3(self.server.url, "token0", create=True)
+        idb.submit_machines(self.machines(6))
+
+        self.assertEqual([x[0] for x in self.server.log],
+                         ["GET"] + ["GET", "PUT"] * 5 + ["GET", "POST"])
+        self.assertEqual(self.server.machines["vm5.example.org"]["cores"], 2)
+
+
+class SyncStateTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubIDB()
+        self.directory = tempfile.mkdtemp()
+        idbiaas.SyncState.directory = self.directory
+
+    def tearDown(self):
+        idbiaas.SyncState.directory = None
+        idbiaas.SyncState.full_resync = False
+        idbiaas.SyncState._states = {}
+        idbiaas.IDBSessions.close()
+        shutil.rmtree(self.directory)
+        self.server.stop()
+
+    def run_zone(self, machines, complete=True):
+        zone = FakeZone(idbiaas.IDBv3(self.server.url, "idbtoken", create=True), 0, machines)
+        zone.key = "zone"
+        zone.complete = complete
+        del self.server.log[:]
+        summary = idbiaas.IDBIaas.run_zones([zone])
+        idbiaas.SyncState.save_all()
+        self.summary = summary
+        return [x[0] for x in self.server.log]
+
+    def reload(self):
+        idbiaas.SyncState._states = {}
+
+    def test_skip_unchanged(self):
+        machines = [idbiaas.IDBMachine("vm%d.example.org" % i, "", 1, 1024) for i in range(3)]
+        self.assertEqual(self.run_zone(machines), ["GET"] + ["GET", "POST"] * 3)
+
+        self.reload()
+        self.assertEqual(self.run_zone(machines), [])
+
+        machines[1].ram = 2048
+        self.assertEqual(self.run_zone(machines), ["GET", "GET", "PUT"])
+
+        idbiaas.SyncState.full_resync = True
+        self.assertEqual(self.run_zone(machines), ["GET", "GET", "PUT", "PUT", "PUT"])
+
+    def test_ttl(self):
+        machines = [idbiaas.IDBMachine("vm0.example.org", "", 1, 1024)]
+        self.run_zone(machines)
+
+        state = idbiaas.SyncState.for_url(self.server.url)
+        state.entries["vm0.example.org"][1] -= idbiaas.SyncState.ttl + 1
+        self.assertEqual(self.run_zone(machines), ["GET", "GET", "PUT"])
+
+    def test_disappeared(self):
+        machines = [idbiaas.IDBMachine("vm%d.example.org" % i, "", 1, 1024) for i in range(3)]
+        self.run_zone(machines)
+        self.run_zone(machines[:2])
+
+        state = idbiaas.SyncState.for_url(self.server.url)
+        self.assertEqual(sorted(state.entries.keys()), ["vm0.example.org", "vm1.example.org"])
+        self.assertEqual(self.run_zone(machines), ["GET", "GET", "PUT"])
+
+    def test_incomplete(self):
+        machines = [idbiaas.IDBMachine("vm%d.example.org" % i, "", 1, 1024) for i in range(3)]
+        self.run_zone(machines)
+
+        # vm2 is on a host which failed
+        self.run_zone(machines[:2], complete=False)
+        self.assertEqual(self.summary["disappeared"], 0)
+
+        state = idbiaas.SyncState.for_url(self.server.url)
+        self.assertEqual(sorted(state.entries.keys()), ["vm%d.example.org" % i for i in range(3)])
+        self.assertEqual((state.seen, state.pending), ({}, {}))
+        self.assertEqual(self.run_zone(machines), [])
+
+    def test_crawl_failed(self):
+        machines = [idbiaas.IDBMachine("vm%d.example.org" % i, "", 1, 1024) for i in range(3)]
+        self.run_zone(machines)
+
+        def crawl():
+            yield machines[0]
+            raise Exception("API gone")
+
+        # the machines after the failure didn't disappear
+        self.run_zone(crawl())
+        self.assertEqual((self.summary["disappeared"], self.summary["failed_zones"]), (0, 1))
+        state = idbiaas.SyncState.for_url(self.server.url)
+        self.assertEqual(sorted(state.entries.keys()), ["vm%d.example.org" % i for i in range(3)])
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubIDB()
+        self.directory = tempfile.mkdtemp()
+        idbiaas.Metrics.reset()
+        idbiaas.Metrics.enabled = True
+
+    def tearDown(self):
+        idbiaas.Metrics.enabled = False
+        idbiaas.Metrics.json_path = None
+        idbiaas.Metrics.textfile_path = None
+        idbiaas.Metrics.reset()
+        idbiaas.IDBSessions.close()
+        shutil.rmtree(self.directory)
+        self.server.stop()
+
+    def metrics(self, name):
+        return dict((tuple(sorted(m["labels"].items())), m) for m in idbiaas.Metrics.report()["metrics"]
+                    if m["name"] == name)
+
+    def test_disabled(self):
+        idbiaas.Metrics.enabled = False
+        self.assertIsNone(idbiaas.Metrics.start())
+        idbiaas.Metrics.observe("idb_request", (), idbiaas.Metrics.start())
+        self.assertEqual(idbiaas.Metrics.report()["metrics"], [])
+
+    def test_requests(self):
+        self.server.reject.add("vm3.example.org")
+        zone = FakeZone(idbiaas.IDBv2(self.server.url, "idbtoken", chunksize=2), 0,
+                        [idbiaas.IDBMachine("vm%d.example.org" % i, "", 1, 1024) for i in range(4)])
+        zone.key = "zone"
+        idbiaas.IDBIaas.run_zones([zone])
+
+        crawl = self.metrics("zone_crawl")[(("type", "FakeZone"), ("zone", "zone"))]
+        self.assertEqual((crawl["count"], crawl["errors"], crawl["machines"]), (1, 0, 4))
+
+        # the rejected second chunk is split in two requests
+        put = self.metrics("idb_request")[(("request", "bulk_put"), ("url", self.server.url))]
+        self.assertEqual((put["count"], put["errors"]), (4, 2))
+        self.assertEqual(put["error_rate"], 0.5)
+        self.assertGreater(put["bytes"], 0)
+        self.assertEqual(sum(put["buckets"].values()), 4)
+
+    def test_merge(self):
+        idbiaas.Metrics.observe("libvirt_host", (("host", "a"),), time.time(), False, 3)
+        idbiaas.Metrics.merge(idbiaas.Metrics.snapshot())
+        idbiaas.Metrics.merge([((("libvirt_host", (("host", "b"),))), {"count": 1, "errors": 1, "seconds": 0.5,
+                                                                       "size": 0, "buckets": [0] * 14})])
+
+        hosts = self.metrics("libvirt_host")
+        self.assertEqual((hosts[(("host", "a"),)]["count"], hosts[(("host", "a"),)]["machines"]), (2, 6))
+        self.assertEqual(hosts[(("host", "b"),)]["errors"], 1)
+
+    def test_write(self):
+        idbiaas.Metrics.json_path = self.directory + "/metrics.json"
+        idbiaas.Metrics.textfile_path = self.directory + "/metrics.prom"
+        idbiaas.Metrics.observe("libvirt_host", (("host", "qemu+ssh://a/system"),), time.time(), True, 3)
+        idbiaas.Metrics.write()
+
+        with open(idbiaas.Metrics.json_path) as f:
+            self.assertEqual(json.load(f)["metrics"][0]["machines"], 3)
+
+        with open(idbiaas.Metrics.textfile_path) as f:
+            text = f.read()
+        self.assertIn('idbiaas_libvirt_host_seconds_bucket{host="qemu+ssh://a/system",le="+Inf"} 1\n', text)
+        self.assertIn('idbiaas_libvirt_host_errors_total{host="qemu+ssh://a/system"} 1\n', text)
+        self.assertIn('idbiaas_libvirt_host_machines_total{host="qemu+ssh://a/system"} 3\n', text)
+
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubIDB()
+        self.directory = tempfile.mkdtemp()
+        idbiaas.Trace.reset()
+        idbiaas.Trace.enabled = True
+        idbiaas.Trace.path = os.path.join(self.directory, "trace.json")
+
+    def tearDown(self):
+        idbiaas.Trace.enabled = False
+        idbiaas.Trace.path = None
+        idbiaas.Trace.reset()
+        idbiaas.Metrics.reset()
+        idbiaas.IDBSessions.close()
+        shutil.rmtree(self.directory)
+        self.server.stop()
+
+    def test_spans(self):
+        zone = FakeZone(idbiaas.IDBv3(self.server.url, "idbtoken", create=True), 0,
+                        [idbiaas.IDBMachine("vm%d.example.org" % i, "", 1, 1024) for i in range(2)])
+        zone.key = "zone"
+        idbiaas.IDBIaas.run_zones([zone])
+        idbiaas.Trace.write()
+
+        with open(idbiaas.Trace.path) as f:
+            events = json.load(f)["traceEvents"]
+        spans = [e for e in events if e["ph"] == "X"]
+        self.assertEqual(sorted(e["name"] for e in spans),
+                         ["idb_request %s get" % self.server.url] * 2 + ["idb_request %s list" % self.server.url] +
+                         ["idb_request %s post" % self.server.url] * 2 +
+                         ["zone_crawl zone FakeZone", "zone_run zone FakeZone"])
+        self.assertEqual(set((e["pid"], e["tid"]) for e in events if e["ph"] == "M"),
+                         set((e["pid"], e["tid"]) for e in spans))
+
+        # tracing doesn't enable the metrics
+        self.assertEqual(idbiaas.Metrics.report()["metrics"], [])
+
+    def test_disabled(self):
+        idbiaas.Trace.enabled = False
+        self.assertIsNone(idbiaas.Metrics.start())
+
+    def test_profile(self):
+        path = os.path.join(self.directory, "profile")
+
+        def profiled_in_thread():
+            time.sleep(0.01)
+
+        idbiaas.Profile.start()
+        idbiaas.map_bounded(lambda x: profiled_in_thread(), range(2), 2)
+        idbiaas.Profile.stop(path)
+
+        functions = [f[2] for f in pstats.Stats(path).stats]
+        self.assertTrue("profiled_in_thread" in functions)
+        self.assertTrue("map_bounded" in functions)
+
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubIDB(FlakyIDBHandler)
+        self.server.machines["vm0.example.org"] = {"fqdn": "vm0.example.org"}
+
+    def tearDown(self):
+        idbiaas.IDBSessions.close()
+        idbiaas.CircuitBreaker._breakers = {}
+        self.server.stop()
+
+    def idb(self, version=3, **config):
+        config = dict({"url": self.server.url, "token": "idbtoken", "create": True, "backoff": 0.01}, **config)
+        if version == 2:
+            return idbiaas.IDBv2.from_dict(config)
+        return idbiaas.IDBv3.from_dict(config)
+
+    def machines(self, n):
+        return [idbiaas.IDBMachine("vm%d.example.org" % i, "", 2, 2048) for i in range(n)]
+
+    def requests(self):
+        return [x[0] for x in self.server.log]
+
+    def test_retry_after(self):
+        self.server.faults = [(503, {"Retry-After": "0"}, 0), (429, {}, 0)]
+        self.idb(prefetch=False).submit_machine(self.machines(1)[0])
+        self.assertEqual(self.requests(), ["GET", "GET", "GET", "PUT"])
+        self.assertEqual(self.server.machines["vm0.example.org"]["cores"], 2)
+
+    def test_retry_bulk_put(self):
+        self.server.faults = [(500, {}, 0), (502, {}, 0)]
+        self.idb(version=2).submit_machines(self.machines(2))
+        self.assertEqual(self.requests(), ["PUT", "PUT", "PUT"])
+        self.assertEqual(self.server.machines["vm1.example.org"]["cores"], 2)
+
+    def test_post_not_repeated(self):
+        self.server.faults = [(500, {}, 0)]
+        idb = self.idb(prefetch=False)
+        idb.create_machine("idbtoken", self.machines(2)[1])
+        self.assertEqual(self.requests(), ["POST"])
+
+        self.server.faults = [(503, {}, 0)]
+        idb.create_machine("idbtoken", self.machines(2)[1])
+        self.assertEqual(self.requests(), ["POST", "POST", "POST"])
+        self.assertTrue(self.server.machines.has_key("vm1.example.org"))
+
+    def test_timeout(self):
+        self.server.faults = [(None, {}, 0.5)]
+        idb = self.idb(prefetch=False, timeout=[1, 0.1], retries=1)
+        start = time.time()
+        self.assertEqual(idb.machine_token(self.machines(1)[0]), "idbtoken")
+        self.assertLess(time.time() - start, 0.45)
+
+    def test_hedge(self):
+        self.server.faults = [(None, {}, 0.5)]
+        idb = self.idb(prefetch=False, hedge_after=0.05)
+        start = time.time()
+        self.assertEqual(idb.machine_token(self.machines(1)[0]), "idbtoken")
+        self.assertLess(time.time() - start, 0.45)
+
+    def test_circuit_breaker(self):
+        self.server.faults = [(500, {}, 0)] * 10
+        idb = self.idb(prefetch=False, retries=1, breaker_threshold=2, breaker_reset=60)
+        idb.submit_machines(self.machines(4))
+
+        # two failed checks of the first machine open the breaker, the other machines are skipped
+        self.assertEqual(self.requests(), ["GET", "GET"])
+        self.assertTrue(idb.retry.breaker.open)
+        self.assertRaises(idbiaas.CircuitOpenError, idb.machine_token, self.machines(1)[0])
+
+    def test_breaker_trial(self):
+        breaker = idbiaas.CircuitBreaker(threshold=1, reset_timeout=0.05)
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        # only one trial request at a time
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertTrue(breaker.open)
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertFalse(breaker.open)
+
+    def test_delay(self):
+        policy = idbiaas.RetryPolicy(self.server.url)
+        response = requests.models.Response()
+        response.headers["Retry-After"] = "2"
+        self.assertEqual(policy.delay(0, response), 2)
+        response.headers["Retry-After"] = "3600"
+        self.assertIsNone(policy.delay(0, response))
+        response.headers["Retry-After"] = email.utils.formatdate(time.time() + 5, usegmt=True)
+        self.assertTrue(3 < policy.delay(0, response) <= 5)
+        self.assertTrue(0 <= policy.delay(3, None) <= 4)
+
+
+class ConfigCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubIDB(StubConfigHandler)
+        self.server.providers = [{"name": "other", "config": "{}"},
+                                 {"name": "idbiaas", "config": json.dumps({"zones": []})}]
+        self.directory = tempfile.mkdtemp()
+        idbiaas.ConfigCache.directory = self.directory
+
+    def tearDown(self):
+        idbiaas.ConfigCache.directory = None
+        idbiaas.ConfigCache.max_age = 0
+        idbiaas.IDBSessions.close()
+        shutil.rmtree(self.directory)
+        self.server.stop()
+
+    def test_revalidate(self):
+        for load in (idbiaas.IDBIaas.v2_url_config, idbiaas.IDBIaas.v3_url_config):
+            self.assertEqual(load(self.server.url, "token", "idbiaas", True), {"zones": []})
+            self.assertEqual(load(self.server.url, "token", "idbiaas", True), {"zones": []})
+
+        self.server.etag = '"2"'
+        self.server.providers[1]["config"] = json.dumps({"zones": [], "concurrency": 2})
+        self.assertEqual(idbiaas.IDBIaas.v2_url_config(self.server.url, "token", "idbiaas", True),
+                         {"zones": [], "concurrency": 2})
+
+        self.assertEqual([x[1] for x in self.server.log], ["/cloud_providers"] * 2 + ["/cloud_providers/idbiaas"] * 2
+                         + ["/cloud_providers"])
+        self.assertRaises(Exception, idbiaas.IDBIaas.v2_url_config, self.server.url, "token", "missing", True)
+
+    def test_max_age(self):
+        idbiaas.ConfigCache.max_age = 60
+        idbiaas.IDBIaas.v3_url_config(self.server.url, "token", "idbiaas", True)
+        self.assertEqual(idbiaas.IDBIaas.v3_url_config(self.server.url, "token", "idbiaas", True), {"zones": []})
+        self.assertEqual(len(self.server.log), 1)
+
+        # a different token may see another config
+        idbiaas.IDBIaas.v3_url_config(self.server.url, "token2", "idbiaas", True)
+        self.assertEqual(len(self.server.log), 2)
+
+    def test_stale_fallback(self):
+        url = self.server.url
+        idbiaas.IDBIaas.v2_url_config(url, "token", "idbiaas", True)
+        self.server.stop()
+        idbiaas.IDBSessions.close()
+
+        self.assertEqual(idbiaas.IDBIaas.v2_url_config(url, "token", "idbiaas", True), {"zones": []})
+        self.assertRaises(requests.exceptions.RequestException,
+                          idbiaas.IDBIaas.v3_url_config, url, "token", "idbiaas", True)
+        self.server = StubIDB()
+
+    def test_private(self):
+        idbiaas.ConfigCache.directory = os.path.join(self.directory, "config")
+        idbiaas.IDBIaas.v2_url_config(self.server.url, "token", "idbiaas", True)
+
+        self.assertEqual(os.stat(idbiaas.ConfigCache.directory).st_mode & 0777, 0700)
+        files = os.listdir(idbiaas.ConfigCache.directory)
+        self.assertEqual(len(files), 1)
+        path = os.path.join(idbiaas.ConfigCache.directory, files[0])
+        self.assertEqual(os.stat(path).st_mode & 0777, 0600)
+        # the configs of the other adapters are not cached
+        with open(path) as f:
+            self.assertEqual(json.load(f)["data"], json.dumps({"zones": []}))
+
+
+class ConcurrentEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubIDB()
+        self.server.latency = 0.02
+        for i in range(0, 20, 2):
+            fqdn = "vm%d.example.org" % i
+            self.server.machines[fqdn] = {"fqdn": fqdn}
+            self.server.owners[fqdn] = "token%d" % (i % 4)
+
+    def tearDown(self):
+        idbiaas.IDBSessions.close()
+        idbiaas.RateLimiter._limiters = {}
+        self.server.stop()
+
+    def submit(self, config):
+        idb = idbiaas.IDBv3.from_dict(dict({"url": self.server.url, "token": "token0", "create": True}, **config))
+        start = time.time()
+        idb.submit_machines([idbiaas.IDBMachine("vm%d.example.org" % i, "", 1, 1024) for i in range(20)])
+        return time.time() - start
+
+    def test_from_dict(self):
+        idb = idbiaas.IDBv3.from_dict({"url": self.server.url, "token": "token0", "engine": "concurrent",
+                                       "inflight": 4, "rate_limit": 10})
+        self.assertEqual(idb.engine, "concurrent")
+        self.assertEqual(idb.inflight, 4)
+        self.assertEqual(idb.rate_limit, 10)
+        self.assertRaises(idbiaas.InvalidZoneConfigError, idbiaas.IDBv3.from_dict,
+                          {"url": self.server.url, "token": "token0", "engine": "async"})
+        self.assertRaises(idbiaas.InvalidZoneConfigError, idbiaas.IDBv3.from_dict,
+                          {"url": self.server.url, "token": "token0", "token_rate_limit": {"patch": 1}})
+
+    def test_speedup(self):
+        serial = self.submit({"prefetch": False})
+        self.assertEqual(sorted(self.server.machines.keys()), sorted("vm%d.example.org" % i for i in range(20)))
+
+        concurrent = self.submit({"prefetch": False, "engine": "concurrent", "inflight": 8})
+        self.assertLess(concurrent * 3, serial)
+
+    def test_multitoken(self):
+        idb = idbiaas.IDBv3(self.server.url, ["token0", "token2"], create=True)
+        idb.engine = "concurrent"
+        idb.submit_machines([idbiaas.IDBMachine("vm%d.example.org" % i, "", 4, 1024) for i in range(4)])
+
+        self.assertEqual(self.server.machines["vm2.example.org"]["cores"], 4)
+        self.assertFalse(self.server.machines.has_key("vm1.example.org"))
+        self.assertFalse("POST" in [x[0] for x in self.server.log])
+
+    def test_rate_limit(self):
+        self.server.latency = 0
+        elapsed = self.submit({"engine": "concurrent", "rate_limit": 20, "prefetch": False})
+        # 40 requests, 20 as burst, the remaining 20 take a second
+        self.assertGreater(elapsed, 0.9)
+
+    def test_token_rate_limit(self):
+        self.server.latency = 0
+        elapsed = self.submit({"engine": "concurrent", "token_rate_limit": 20, "prefetch": False})
+        # 20 GETs, 10 POSTs and 5 PUTs with token0, 20 as burst, the remaining 15 take 0.75 seconds
+        self.assertGreater(elapsed, 0.7)
+
+    def test_owner_pipelines(self):
+        self.server.latency = 0
+        for i in range(20):
+            fqdn = "vm%d.example.org" % i
+            self.server.machines[fqdn] = {"fqdn": fqdn}
+            self.server.owners[fqdn] = "token0" if i < 10 else "token1"
+
+        idb = idbiaas.IDBv3.from_dict({"url": self.server.url, "token": ["token0", "token1"], "engine": "concurrent",
+                                       "inflight": 2, "token_rate_limit": {"put": 5}})
+        pulled = []
+
+        def machines():
+            for i in range(20):
+                yield idbiaas.IDBMachine("vm%d.example.org" % i, "", 1, 1024)
+                pulled.append(time.time())
+
+        start = time.time()
+        idb.submit_machines(machines())
+        elapsed = time.time() - start
+
+        # the queue of a throttled owner is bounded, the crawl waits for it
+        self.assertGreater(pulled[9] - start, 0.1)
+
+        # 10 PUTs per token, 5 as burst, take a second; token1 doesn't wait for the machines of token0
+        self.assertGreater(elapsed, 0.9)
+        self.assertLess(elapsed, 1.6)
+        self.assertEqual(len([x for x in self.server.log if x[0] == "PUT"]), 20)
+
+
+class CountingIDBHandler(StubIDBHandler):
+    """Counts the requests the stub IDB handles at the same time in server.max_active."""
+
+    def count(self, handle):
+        with self.server.lock:
+            self.server.active = getattr(self.server, "active", 0) + 1
+            self.server.max_active = max(getattr(self.server, "max_active", 0), self.server.active)
+        time.sleep(self.server.latency)
+        try:
+            handle(self)
+        finally:
+            with self.server.lock:
+                self.server.active -= 1
+
+    def do_GET(self):
+        self.count(StubIDBHandler.do_GET)
+
+    def do_POST(self):
+        self.count(StubIDBHandler.do_POST)
+
+    def do_PUT(self):
+        self.count(StubIDBHandler.do_PUT)
+
+
+class FakeZone(object):
+    complete = True
+
+    def __init__(self, idb, delay, machines):
+        self.idb = idb
+        self.delay = delay
+        self._machines = machines
+
+    def machines(self):
+        time.sleep(self.delay)
+        return self._machines
+
+
+class FakeIDB(object):
+    state = None
+    reconcile = None
+
+    def __init__(self, url, delay=0):
+        self.url = url
+        self.delay = delay
+        self.submitted = []
+
+    def submit_machines(self, machines):
+        time.sleep(self.delay)
+        self.submitted.extend(machines)
+
+
+class StreamingZone(object):
+    key = "streaming"
+
+    def __init__(self, idb, n, delay):
+        self.idb = idb
+        self.n = n
+        self.delay = delay
+
+    def machines(self):
+        for i in range(self.n):
+            time.sleep(self.delay)
+            yield idbiaas.IDBMachine("vm%d.example.org" % i, "", 1, 1024)
+
+
+class StreamingIDB(FakeIDB):
+    def submit_machines(self, machines):
+        self.first = None
+        for machine in machines:
+            if self.first is None:
+                self.first = time.time()
+            self.submitted.append(machine)
+
+
+class StreamingTest(unittest.TestCase):
+    def test_first_machine(self):
+        idb = StreamingIDB("http://example.org")
+        start = time.time()
+        idbiaas.IDBIaas.run_zones([StreamingZone(idb, 10, 0.05)])
+
+        self.assertEqual(len(idb.submitted), 10)
+        self.assertLess(idb.first - start, 0.25)
+        self.assertGreater(time.time() - start, 0.45)
+
+    def test_imap_bounded_lazy(self):
+        pulled = []
+
+        def items():
+            for i in range(10):
+                pulled.append(i)
+                yield i
+
+        results = idbiaas.imap_bounded(lambda i: i, items(), concurrency=2)
+        self.assertEqual(next(results), 0)
+        self.assertLessEqual(len(pulled), 3)
+        self.assertEqual(list(results), range(1, 10))
+
+    def test_buffered(self):
+        pulled = []
+
+        def items():
+            for i in range(10):
+                pulled.append(i)
+                yield i
+
+        results = idbiaas.buffered(items(), 3)
+        self.assertEqual(next(results), 0)
+        time.sleep(0.05)
+        self.assertLessEqual(len(pulled), 5)
+        self.assertEqual(list(results), range(1, 10))
+
+    def test_buffered_error(self):
+        def items():
+            yield 0
+            raise ValueError("crawl failed")
+
+        results = idbiaas.buffered(items(), 3)
+        self.assertEqual(next(results), 0)
+        self.assertRaises(ValueError, next, results)
+
+    def test_buffered_stop(self):
+        closed = threading.Event()
+
+        def items():
+            try:
+                for i in range(10):
+                    yield i
+            finally:
+                closed.set()
+
+        results = idbiaas.buffered(items(), 1)
+        self.assertEqual(next(results), 0)
+        results.close()
+
+        # the producer doesn't block on the full queue forever
+        closed.wait(1)
+        self.assertTrue(closed.is_set())
+
+
+class DaemonTest(unittest.TestCase):
+    def run_daemon(self, configs, delays, seconds, interval):
+        """Run the daemon for seconds, zones of configs crawl for their delay in delays."""
+        self.idb = FakeIDB("http://example.org")
+        self.loaded = []
+        calls = []
+
+        def load_config():
+            calls.append(1)
+            return configs[min(len(calls), len(configs)) - 1]
+
+        def zones_from_dict(config):
+            self.loaded.append(config)
+            zones = []
+            for key in config["zones"]:
+                zone = FakeZone(self.idb, delays.get(key, 0), [idbiaas.IDBMachine(key + ".example.org", "", 1, 1024)])
+                zone.key = key
+                zone.interval = None
+                zones.append(zone)
+            return zones
+
+        x = idbiaas.IDBIaas(None)
+        stop = threading.Event()
+        threading.Timer(seconds, stop.set).start()
+        original = idbiaas.IDBIaas.zones_from_dict
+        idbiaas.IDBIaas.zones_from_dict = staticmethod(zones_from_dict)
+        try:
+            x.run_daemon(load_config, interval=interval, reload_interval=0.1, stop=stop)
+        finally:
+            idbiaas.IDBIaas.zones_from_dict = original
+
+        return x, [m.fqdn for m in self.idb.submitted]
+
+    def test_run_daemon(self):
+        x, fqdns = self.run_daemon([{"zones": ["a"]}, {"zones": ["a"]}, {"zones": ["a", "b"]}], {}, 0.5, 0.2)
+
+        # zones are rebuilt for the first and the changed config only
+        self.assertEqual(len(self.loaded), 2)
+        self.assertEqual(x.config, {"zones": ["a", "b"]})
+        self.assertGreaterEqual(fqdns.count("a.example.org"), 2)
+        self.assertGreaterEqual(fqdns.count("b.example.org"), 1)
+
+    def test_several_idbs(self):
+        idbs = [FakeIDB("http://a.example.org"), FakeIDB("http://b.example.org")]
+
+        def zones_from_dict(config):
+            zones = []
+            for idb in idbs:
+                zone = FakeZone(idb, 0, [idbiaas.IDBMachine("vm0.example.org", "", 1, 1024)])
+                zone.key = "same driver"
+                zone.interval = None
+                zones.append(zone)
+            return zones
+
+        stop = threading.Event()
+        threading.Timer(0.2, stop.set).start()
+        original = idbiaas.IDBIaas.zones_from_dict
+        idbiaas.IDBIaas.zones_from_dict = staticmethod(zones_from_dict)
+        try:
+            idbiaas.IDBIaas(None).run_daemon(lambda: {"zones": []}, interval=1, stop=stop)
+        finally:
+            idbiaas.IDBIaas.zones_from_dict = original
+
+        # zones of the same driver submitting to different IDBs have their own workers
+        self.assertEqual([len(idb.submitted) for idb in idbs], [1, 1])
+
+    def test_independent_schedules(self):
+        x, fqdns = self.run_daemon([{"zones": ["fast", "slow"]}], {"slow": 0.6}, 0.5, 0.1)
+
+        # the fast zone keeps its schedule while the slow zone is still crawled
+        self.assertEqual(fqdns.count("slow.example.org"), 1)
+        self.assertGreaterEqual(fqdns.count("fast.example.org"), 3)
+
+
+class RunZonesTest(unittest.TestCase):
+    def test_parallel(self):
+        idb = FakeIDB("http://example.org")
+        zones = [FakeZone(idb, 0.2, [idbiaas.IDBMachine("vm%d.example.org" % i, "", 1, 1024)]) for i in range(4)]
+
+        start = time.time()
+        idbiaas.IDBIaas.run_zones(zones, concurrency=4)
+        self.assertLess(time.time() - start, 0.6)
+        self.assertEqual(sorted(m.fqdn for m in idb.submitted),
+                         ["vm0.example.org", "vm1.example.org", "vm2.example.org", "vm3.example.org"])
+
+    def test_idb_concurrency(self):
+        server = StubIDB(CountingIDBHandler)
+        server.latency = 0.01
+        try:
+            zones = []
+            for i in range(4):
+                idb = idbiaas.IDBv3(server.url, "idbtoken", create=True, prefetch=False)
+                idb.engine = "concurrent"
+                zones.append(FakeZone(idb, 0, [idbiaas.IDBMachine("vm%d-%d.example.org" % (i, j), "", 1, 1024)
+                                               for j in range(4)]))
+
+            idbiaas.IDBIaas.run_zones(zones, concurrency=4, idb_concurrency=2)
+        finally:
+            idbiaas.IDBSessions.close()
+            idbiaas.InflightLimiter._limiters = {}
+            server.stop()
+
+        # the requests of all zones share the slots of the IDB url
+        self.assertEqual(len(server.machines), 16)
+        self.assertEqual(server.max_active, 2)
+
+
+class ReconcileZone(object):
+    key = "reconcile"
+    complete = True
+    interval = None
+
+    def __init__(self, idb, machines):
+        self.idb = idb
+        self._machines = machines
+
+    def machines(self):
+        return self._machines
+
+
+class ReconcileTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubIDB()
+        for i in range(6):
+            fqdn = "vm%d.example.org" % i
+            self.server.machines[fqdn] = {"fqdn": fqdn, "vmhost": "host0" if i < 4 else "host1"}
+            self.server.owners[fqdn] = "token%d" % (i % 2)
+
+    def tearDown(self):
+        idbiaas.IDBSessions.close()
+        idbiaas.IDBv3.reconcile_dry_run = False
+        self.server.stop()
+
+    def run_zone(self, reconcile, complete=True, **config):
+        idb = idbiaas.IDBv3.from_dict(dict({"url": self.server.url, "token": ["token0", "token1"],
+                                            "reconcile": reconcile}, **config))
+        zone = ReconcileZone(idb, [idbiaas.IDBMachine("vm%d.example.org" % i, "host0", 1, 1024) for i in range(2)])
+        zone.complete = complete
+        return idbiaas.IDBIaas.run_zones([zone])
+
+    def test_from_dict(self):
+        self.assertRaises(idbiaas.InvalidZoneConfigError, idbiaas.IDBv3.from_dict,
+                          {"url": self.server.url, "token": "token0", "reconcile": "purge"})
+        self.assertRaises(idbiaas.InvalidZoneConfigError, idbiaas.IDBv2.from_dict,
+                          {"url": self.server.url, "token": "token0", "reconcile": "delete"})
+        self.assertEqual(idbiaas.IDBv3.from_dict({"url": self.server.url, "token": "token0"}).reconcile, None)
+
+    def test_report(self):
+        summary = self.run_zone("report")
+        self.assertEqual((summary["orphans"], summary["deleted"]), (2, 0))
+        self.assertEqual(len(self.server.machines), 6)
+
+    def test_delete(self):
+        summary = self.run_zone("delete")
+        self.assertEqual((summary["orphans"], summary["deleted"]), (2, 2))
+        self.assertEqual(sorted(self.server.machines),
+                         ["vm%d.example.org" % i for i in (0, 1, 4, 5)])
+        # the machines are listed once per token, up to the empty page, for both submitting and reconciling
+        self.assertEqual(len([x for x in self.server.log if x[0] == "GET"]), 4)
+
+    def test_safety(self):
+        summary = self.run_zone("delete", max_delete=1)
+        self.assertEqual((summary["orphans"], summary["deleted"]), (2, 0))
+
+        idbiaas.IDBv3.reconcile_dry_run = True
+        summary = self.run_zone("delete")
+        self.assertEqual((summary["orphans"], summary["deleted"]), (2, 0))
+
+        idbiaas.IDBv3.reconcile_dry_run = False
+        summary = self.run_zone("delete", complete=False)
+        self.assertEqual((summary["orphans"], summary["deleted"]), (0, 0))
+        self.assertFalse("DELETE" in [x[0] for x in self.server.log])
+
+    def zones(self, reconcile_b=None):
+        idb = {"url": self.server.url, "token": ["token0", "token1"]}
+        a = ReconcileZone(idbiaas.IDBv3.from_dict(dict(idb, reconcile="delete")),
+                          [idbiaas.IDBMachine("vm%d.example.org" % i, "host0", 1, 1024) for i in range(2)])
+        a.key = "a"
+        # vm2 moved from host0 of zone a to host1 of zone b
+        b = ReconcileZone(idbiaas.IDBv3.from_dict(dict(idb, reconcile=reconcile_b)),
+                          [idbiaas.IDBMachine("vm2.example.org", "host1", 1, 1024)])
+        b.key = "b"
+        return a, b
+
+    def test_moved(self):
+        summary = idbiaas.IDBIaas.run_zones(self.zones())
+        self.assertEqual((summary["orphans"], summary["deleted"]), (1, 1))
+        self.assertTrue(self.server.machines.has_key("vm2.example.org"))
+        self.assertFalse(self.server.machines.has_key("vm3.example.org"))
+        self.assertEqual(len([x for x in self.server.log if x[0] == "DELETE"]), 1)
+
+    def test_incomplete_zone_of_url(self):
+        a, b = self.zones()
+        b.complete = False
+        summary = idbiaas.IDBIaas.run_zones([a, b])
+        self.assertEqual((summary["orphans"], summary["deleted"]), (0, 0))
+
+        # a part of the zones, e.g. a shard, isn't reconciled either
+        summary = idbiaas.IDBIaas.run_zones([a, b], reconciler=idbiaas.Reconciler([a, b], False))
+        self.assertEqual((summary["orphans"], summary["deleted"]), (0, 0))
+        self.assertFalse("DELETE" in [x[0] for x in self.server.log])
+
+    def test_windows(self):
+        a, b = self.zones()
+        reconciler = idbiaas.Reconciler([a, b])
+
+        # the url is reconciled once both zones ran, e.g. with their own intervals in daemon mode
+        summary = idbiaas.IDBIaas.run_zones([a], reconciler=reconciler)
+        self.assertEqual(summary["orphans"], 0)
+        summary = idbiaas.IDBIaas.run_zones([b], reconciler=reconciler)
+        self.assertEqual((summary["orphans"], summary["deleted"]), (1, 1))
+
+        # vm1 left zone a, machines crawled in the previous window are kept
+        a._machines = a._machines[:1]
+        idbiaas.IDBIaas.run_zones([a, b], reconciler=reconciler)
+        self.assertTrue(self.server.machines.has_key("vm1.example.org"))
+        idbiaas.IDBIaas.run_zones([a, b], reconciler=reconciler)
+        self.assertFalse(self.server.machines.has_key("vm1.example.org"))
+
+    def test_disappeared(self):
+        idb = idbiaas.IDBv3(self.server.url, ["token0", "token1"])
+        idb.reconcile = "delete"
+        self.assertEqual(idb.reconcile_machines(set(["vm0.example.org"]), [""],
+                                                ["vm5.example.org", "vm6.example.org"]),
+                         (1, 1))
+        self.assertEqual(self.server.log[-1], ("DELETE", "/machines/vm5.example.org"))
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "snapshot.json.gz")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def machines(self, n):
+        machines = [idbiaas.IDBMachine(u"vm%d\xe4.example.org" % i, "host0", i, 1024) for i in range(n)]
+        machines[0].diskspace = 3072
+        machines[0].nics = [{"name": "vnet0"}]
+        return machines
+
+    def test_roundtrip(self):
+        zones = [ReconcileZone(None, self.machines(3)), ReconcileZone(None, self.machines(2))]
+        zones[1].key = "other"
+        zones[1].complete = False
+        self.assertEqual(idbiaas.Snapshot.export(self.path, zones), {"zones": 2, "failed_zones": 0, "machines": 5})
+
+        idb = FakeIDB("http://example.org")
+        zone = idbiaas.SnapshotZone(ReconcileZone(idb, []), self.path)
+        summary = idbiaas.IDBIaas.run_zones([zone])
+        self.assertEqual(summary["submitted"], 3)
+        self.assertEqual([m.dict() for m in idb.submitted], [m.dict() for m in self.machines(3)])
+        self.assertTrue(zone.complete)
+
+        other = idbiaas.SnapshotZone(ReconcileZone(idb, []), self.path)
+        other.key = "other"
+        self.assertEqual(len(list(other.machines())), 2)
+        self.assertFalse(other.complete)
+
+        other.key = "missing"
+        self.assertEqual(list(other.machines()), [])
+        self.assertFalse(other.complete)
+
+    def test_invalid(self):
+        zone = idbiaas.SnapshotZone(ReconcileZone(None, []), self.path)
+        self.assertEqual(list(zone.machines()), [])
+
+        f = gzip.open(self.path, "wb")
+        f.write('{"format": "other"}\n')
+        f.close()
+        self.assertEqual(list(zone.machines()), [])
+        self.assertFalse(zone.complete)
+
+    def test_export_shard(self):
+        x = idbiaas.IDBIaas({"zones": []}, (0, 2))
+        x.zones = lambda config: [ReconcileZone(None, self.machines(1))]
+        self.assertEqual(x.export(self.path)["machines"], 1)
+
+        zone = idbiaas.SnapshotZone(ReconcileZone(None, []), self.path)
+        self.assertEqual(len(list(zone.machines())), 1)
+        self.assertFalse(zone.complete)
+
+
+class ShardTest(unittest.TestCase):
+    def config(self):
+        return {"zones": [
+            {"idb": libvirt_zone_config["idb"],
+             "driver": {"name": "libvirt", "hosts": [{"name": "host%d.example.org" % i, "user": "u"} for i in range(20)]}},
+            do_zone_config]}
+
+    def test_shard_of(self):
+        names = ["host%d.example.org" % i for i in range(200)]
+        shards = [idbiaas.shard_of(name, 4) for name in names]
+        self.assertEqual(sorted(set(shards)), [0, 1, 2, 3])
+
+        # a new shard only takes names over
+        for name, shard in zip(names, shards):
+            self.assertIn(idbiaas.shard_of(name, 5), (shard, 4))
+
+    def test_zones(self):
+        hosts = []
+        do_zones = 0
+        for i in range(3):
+            zones = idbiaas.IDBIaas(None, (i, 3)).zones(self.config())
+            for zone in zones:
+                if isinstance(zone, idbiaas.LibvirtZone):
+                    hosts.extend(h.name for h in zone.hosts)
+                else:
+                    do_zones += 1
+
+        self.assertEqual(sorted(hosts), sorted("host%d.example.org" % i for i in range(20)))
+        self.assertEqual(do_zones, 1)
+
+    def test_summary(self):
+        idb = FakeIDB("http://example.org")
+        zones = [FakeZone(idb, 0, [idbiaas.IDBMachine("vm%d.example.org" % i, "", 1, 1024)]) for i in range(3)]
+
+        summary = idbiaas.IDBIaas.run_zones(zones)
+        self.assertEqual(summary, {"zones": 3, "failed_zones": 0, "machines": 3, "submitted": 3, "disappeared": 0,
+                                   "orphans": 0, "deleted": 0})
+
+    def test_run_processes(self):
+        do_server = StubIDB(StubDigitalOceanHandler)
+        do_server.droplets = [{"name": "droplet%d" % i, "vcpus": 1, "memory": 512, "tags": ["t%d" % (i % 4)]}
+                              for i in range(20)]
+        idb_server = StubIDB()
+        zones = [{"idb": {"url": idb_server.url, "version": 2, "token": "idbtoken", "create": True},
+                  "driver": dict(do_zone_config["driver"], tag="t%d" % i)} for i in range(4)]
+        api_url = idbiaas.DigitalOceanZone.api_url
+        idbiaas.DigitalOceanZone.api_url = do_server.url + "/v2"
+
+        try:
+            summary = idbiaas.IDBIaas({"zones": zones}).run_processes(2)
+        finally:
+            idbiaas.DigitalOceanZone.api_url = api_url
+            do_server.stop()
+            idb_server.stop()
+
+        self.assertEqual((summary["zones"], summary["machines"], summary["submitted"]), (4, 20, 20))
+        self.assertEqual(sorted(idb_server.machines), sorted("droplet%d" % i for i in range(20)))
+
+
+class StartupTest(unittest.TestCase):
+    def test_libcloud_lazy(self):
+        # a fresh interpreter, this one imported libcloud for the tests
+        output = subprocess.check_output([sys.executable, "-c", "import sys, idbiaas; print 'libcloud' in sys.modules"])
+        self.assertEqual(output.strip(), "False")
+
+
+class BenchTest(unittest.TestCase):
+    def test_bench_run(self):
+        import idbiaas_bench
+        for api in (2, 3):
+            x = idbiaas_bench.bench_run(hosts=2, nodes=3, droplets=4, api=api, latency=0, libvirt_latency=0)
+            self.assertEqual(x["machines"], 10)
+            self.assertEqual(x["submitted"], 10)
+            self.assertTrue(x["stages"].has_key("crawl"))
+
 
 if __name__ == '__main__':
     unittest.main()